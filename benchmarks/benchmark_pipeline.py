@@ -0,0 +1,543 @@
+import os
+import sys
+import json
+import time
+import platform
+import shutil
+import tempfile
+import multiprocessing as mp
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+
+__description__ = '''
+Benchmark every stage of the pipeline on synthetic data, and compare against a stored baseline.
+
+Synthetic inputs are generated in --work_dir (reused if they already exist with the same settings):
+
+    dwi/      multi-shell DWI phantom (sub-01_dwi.nii.gz, .bval, .bvec) of --shape voxels with --n_dirs directions per
+              shell in --shells plus b0s. An ellipsoid "brain" holds four tissues with known diffusion and kurtosis
+              tensors (single fibre, crossing fibres, grey matter-like and CSF-like), simulated with dipy's
+              multi_tensor_dki and Rician noise of --snr. The tissue labels, brain mask and ground truth FA, MD and MK
+              of each tissue are saved alongside.
+    gif/      --n_subjects GIF xml files with --n_labels labels each
+    csvs/     --n_subjects BIDS style roi_metrics csv files
+
+Each benchmark is run --repeats times in a fresh process (the fastest run is kept), so imports are not timed and
+peak memory is that of the benchmark alone. For each run wall time, CPU time (including worker processes), peak
+resident memory (RSS), the increase in peak RSS over the process after its imports and set up, and the peak RSS
+of the largest worker process (for --n_jobs > 1, sampled every 50 ms) are recorded. Peak RSS is measured from after
+the set up of each run (reset through /proc/self/clear_refs on linux, see instrumentation.py), so elsewhere it
+includes the set up, and the worker peak is only measured on linux.
+The DKI and fwDTI benchmarks also record the median absolute error of FA (and MK for DKI) against the ground truth.
+Outputs are checked (accuracy, and that extract_shells outputs hold the right volumes) after the run is measured, so
+checks aren't included in its time or memory.
+
+Results are saved to --output (json). With --baseline, results are compared to a previous --output and any
+benchmark that is slower, uses more memory or is less accurate than the baseline by more than --tolerance is
+reported, and the script exits with status 1. Only compare results from the same machine and phantom settings.
+
+For example:
+
+    python /path/to/benchmark_pipeline.py -w /tmp/benchmark -o baseline.json
+    (upgrade dipy...)
+    python /path/to/benchmark_pipeline.py -w /tmp/benchmark -o after_upgrade.json -bl baseline.json
+'''
+
+# scripts are imported from their directories in the repository
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script_dirs = [os.path.join(repo_dir, x) for x in ['diffusion_mri', 'regions_of_interest', 'csv']]
+
+benchmark_names = ['extract_shells', 'smoothing', 'median_otsu', 'dki_fit', 'fwdti_fit', 'combine_rois',
+                   'read_gif_csv', 'concatenate_csvs']
+
+# collect inputs
+parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                        description=__description__)
+
+parser.add_argument('-w', '--work_dir',
+                    help='Directory for synthetic inputs and benchmark outputs. Default is a new temporary directory.',
+                    required=False)
+parser.add_argument('-o', '--output',
+                    help='Output json file of benchmark results. Default is benchmark_results.json in --work_dir.',
+                    required=False)
+parser.add_argument('-bl', '--baseline',
+                    help='Previous --output to compare results against.',
+                    required=False)
+parser.add_argument('-t', '--tolerance',
+                    help='Fraction a result can be worse than the baseline before it is reported. Default is 0.2.',
+                    type=float,
+                    default=0.2)
+parser.add_argument('-be', '--benchmarks',
+                    help='Benchmarks to run (space separated). Default is all of them.',
+                    nargs='+',
+                    choices=benchmark_names,
+                    default=benchmark_names)
+parser.add_argument('-r', '--repeats',
+                    help='Number of times to run each benchmark (the fastest is kept). Default is 3.',
+                    type=int,
+                    default=3)
+parser.add_argument('-n', '--n_jobs',
+                    help='Number of processes/threads passed to stages that run in parallel. Default is 1.',
+                    type=int,
+                    default=1)
+parser.add_argument('-sh', '--shape',
+                    help='Size of the DWI phantom in voxels (3 values). Default is 64 64 40.',
+                    nargs=3,
+                    type=int,
+                    default=[64, 64, 40])
+parser.add_argument('-vs', '--voxel_size',
+                    help='Voxel size of the DWI phantom in mm. Default is 2.',
+                    type=float,
+                    default=2)
+parser.add_argument('-b', '--shells',
+                    help='Non-zero b-value shells of the DWI phantom (space separated). Default is 1000 2000.',
+                    nargs='+',
+                    type=int,
+                    default=[1000, 2000])
+parser.add_argument('-nd', '--n_dirs',
+                    help='Number of gradient directions per shell. Default is 30.',
+                    type=int,
+                    default=30)
+parser.add_argument('-nb', '--n_b0',
+                    help='Number of b0 volumes. Default is 2.',
+                    type=int,
+                    default=2)
+parser.add_argument('-snr', '--snr',
+                    help='Signal to noise ratio of b0 signal in the phantom. Default is 30.',
+                    type=float,
+                    default=30)
+parser.add_argument('-ns', '--n_subjects',
+                    help='Number of synthetic GIF xml and csv files. Default is 500.',
+                    type=int,
+                    default=500)
+parser.add_argument('-nl', '--n_labels',
+                    help='Number of labels in each synthetic GIF xml file. Default is 150.',
+                    type=int,
+                    default=150)
+
+# tissues of the phantom: label -> (name, compartment eigenvalues (mm^2/s), compartment angles, fractions (%))
+phantom_tissues = {1: ('single_fibre', [[0.00099, 0, 0], [0.00226, 0.00087, 0.00087]], [(90, 0), (90, 0)], [50, 50]),
+                   2: ('crossing_fibres', [[0.00099, 0, 0], [0.00226, 0.00087, 0.00087],
+                                           [0.00099, 0, 0], [0.00226, 0.00087, 0.00087]],
+                       [(90, 0), (90, 0), (90, 90), (90, 90)], [25, 25, 25, 25]),
+                   3: ('grey_matter', [[0.0009, 0.0008, 0.0008], [0.0015, 0.0012, 0.0012]], [(0, 0), (0, 0)],
+                       [60, 40]),
+                   4: ('csf', [[0.003, 0.003, 0.003]], [(0, 0)], [100])}
+
+
+def phantom_settings(args):
+    # settings that define the synthetic inputs - they are regenerated if these change
+    return {'shape': args.shape, 'voxel_size': args.voxel_size, 'shells': args.shells, 'n_dirs': args.n_dirs,
+            'n_b0': args.n_b0, 'snr': args.snr, 'n_subjects': args.n_subjects, 'n_labels': args.n_labels}
+
+
+def make_dwi_phantom(out_dir, shape, voxel_size, shells, n_dirs, n_b0, snr, seed=0):
+    """
+    Simulate a multi-shell DWI of an ellipsoid brain with the tissues in phantom_tissues.
+
+    Saves sub-01_dwi.nii.gz (int16), .bval and .bvec, sub-01_labels.nii.gz (tissue labels), sub-01_mask.nii.gz and
+    sub-01_truth.json (ground truth FA, MD and MK of each tissue).
+    """
+    import numpy as np
+    import nibabel as nib
+    from dipy.core.gradients import gradient_table
+    from dipy.core.sphere import HemiSphere, disperse_charges
+    from dipy.sims.voxel import multi_tensor_dki
+    import dipy.reconst.dki as dki
+    from dipy.reconst.dti import decompose_tensor, from_lower_triangular, fractional_anisotropy
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # evenly spread gradient directions on each shell
+    bvals = [np.zeros(n_b0)]
+    bvecs = [np.zeros((n_b0, 3))]
+    for shell in shells:
+        hemisphere = HemiSphere(theta=np.pi * rng.random(n_dirs), phi=2 * np.pi * rng.random(n_dirs))
+        hemisphere, _ = disperse_charges(hemisphere, 1000)
+        bvals.append(np.full(n_dirs, shell))
+        bvecs.append(hemisphere.vertices)
+    bvals = np.concatenate(bvals)
+    bvecs = np.concatenate(bvecs)
+    gtab = gradient_table(bvals, bvecs=bvecs)
+
+    # noise free signal and ground truth metrics of each tissue
+    s0 = 1000
+    tissue_signals = np.zeros((len(phantom_tissues) + 1, len(bvals)))
+    truth = {}
+    for label, (name, mevals, angles, fractions) in phantom_tissues.items():
+        tissue_signals[label], dt, kt = multi_tensor_dki(gtab, np.array(mevals), S0=s0, angles=angles,
+                                                         fractions=fractions, snr=None)
+        evals, evecs = decompose_tensor(from_lower_triangular(dt))
+        dki_params = np.concatenate((evals, evecs.ravel(), kt))
+        truth[label] = {'name': name,
+                        'FA': float(fractional_anisotropy(evals)),
+                        'MD': float(np.mean(evals)),
+                        'MK': float(dki.mean_kurtosis(dki_params[None], min_kurtosis=0, max_kurtosis=3)[0])}
+
+    # ellipsoid brain split into tissue bands along the first axis
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, x) for x in shape], indexing='ij'))
+    brain = np.sum((grid / 0.8) ** 2, axis=0) <= 1
+    labels = np.where(brain, np.clip(((grid[0] + 0.8) / 1.6 * 4).astype(int) + 1, 1, 4), 0).astype(np.int16)
+
+    # rician noise with standard deviation s0 / snr, one volume at a time to limit memory
+    sigma = s0 / snr
+    data = np.empty(tuple(shape) + (len(bvals),), dtype=np.int16)
+    for v in range(len(bvals)):
+        signal = tissue_signals[labels, v]
+        noisy = np.hypot(signal + rng.normal(0, sigma, signal.shape), rng.normal(0, sigma, signal.shape))
+        data[..., v] = np.clip(np.rint(noisy), 0, np.iinfo(np.int16).max)
+
+    affine = np.diag([voxel_size] * 3 + [1])
+    dwi_file = os.path.join(out_dir, 'sub-01_dwi.nii.gz')
+    nib.save(nib.Nifti1Image(data, affine), dwi_file)
+    np.savetxt(os.path.join(out_dir, 'sub-01_dwi.bval'), [bvals], fmt='%i')
+    np.savetxt(os.path.join(out_dir, 'sub-01_dwi.bvec'), bvecs.T, fmt='%f')
+    nib.save(nib.Nifti1Image(labels, affine), os.path.join(out_dir, 'sub-01_labels.nii.gz'))
+    nib.save(nib.Nifti1Image(brain.astype(np.uint8), affine), os.path.join(out_dir, 'sub-01_mask.nii.gz'))
+    with open(os.path.join(out_dir, 'sub-01_truth.json'), 'w') as f:
+        json.dump(truth, f, indent=1)
+    return dwi_file
+
+
+def make_gif_tree(out_dir, n_subjects, n_labels, seed=0):
+    """
+    Write GIF style xml files (labels and tissues volumes) for n_subjects subjects.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    tissues = ['Non-Brain Outer Tissue', 'Cerebral Spinal Fluid', 'Grey Matter', 'White Matter', 'Deep Grey Matter',
+               'Brain Stem and Pons', 'Non-Brain Low Tissue', 'Non-Brain Mid Tissue', 'Non-Brain High Tissue']
+    for isub in range(n_subjects):
+        sub_dir = os.path.join(out_dir, 'sub-' + str(isub).zfill(4), 'gif')
+        os.makedirs(sub_dir, exist_ok=True)
+        items = []
+        for section, names in [('labels', ['Region ' + str(x) for x in range(n_labels)]), ('tissues', tissues)]:
+            volumes = rng.uniform(100, 20000, (len(names), 2))
+            items.append('<' + section + '>' + ''.join(
+                '<item><number>' + str(i) + '</number><name>' + name + '</name><volumeProb>' + str(prob) +
+                '</volumeProb><volumeCat>' + str(cat) + '</volumeCat></item>'
+                for i, (name, (prob, cat)) in enumerate(zip(names, volumes))) + '</' + section + '>')
+        with open(os.path.join(sub_dir, 'sub-' + str(isub).zfill(4) + '_gif.xml'), 'w') as f:
+            f.write('<?xml version="1.0"?><document><info><dim>3</dim></info>' + ''.join(items) + '</document>')
+
+
+def make_csv_tree(out_dir, n_subjects, seed=0):
+    """
+    Write a BIDS style roi_metrics csv (as extract_roi_metrics.py saves) for n_subjects subjects.
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    for isub in range(n_subjects):
+        sub = 'sub-' + str(isub).zfill(4)
+        os.makedirs(os.path.join(out_dir, sub, 'dwi'), exist_ok=True)
+        n_rows = 50
+        pd.DataFrame({'Label': np.tile(np.arange(1, n_rows // 5 + 1), 5),
+                      'Map': np.repeat(['fwDTI_FA', 'fwDTI_MD', 'fwDTI_FW', 'DKI_MK', 'DKI_AK'], n_rows // 5),
+                      'Voxels': rng.integers(10, 5000, n_rows),
+                      'Mean': rng.random(n_rows),
+                      'Std': rng.random(n_rows),
+                      'Median': rng.random(n_rows)}).to_csv(
+            os.path.join(out_dir, sub, 'dwi', sub + '_roi_metrics.csv'), index=False)
+
+
+def make_inputs(work_dir, args):
+    """
+    Generate synthetic inputs in work_dir, unless they were already made with the same settings. Inputs and outputs
+    of other settings are removed first.
+    """
+    settings_file = os.path.join(work_dir, 'phantom_settings.json')
+    settings = phantom_settings(args)
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            if json.load(f) == settings:
+                print('Using synthetic inputs in: ' + work_dir)
+                return
+    os.makedirs(work_dir, exist_ok=True)
+    print('Generating synthetic inputs in: ' + work_dir)
+    # inputs (and outputs) made with other settings would otherwise be left behind, e.g. csvs of more subjects
+    for old_dir in ['dwi', 'gif', 'csvs', 'outputs']:
+        shutil.rmtree(os.path.join(work_dir, old_dir), ignore_errors=True)
+    make_dwi_phantom(os.path.join(work_dir, 'dwi'), args.shape, args.voxel_size, args.shells, args.n_dirs,
+                     args.n_b0, args.snr)
+    make_gif_tree(os.path.join(work_dir, 'gif'), args.n_subjects, args.n_labels)
+    make_csv_tree(os.path.join(work_dir, 'csvs'), args.n_subjects)
+    with open(settings_file, 'w') as f:
+        json.dump(settings, f, indent=1)
+
+
+def tissue_error(metric_map, labels, truth, metric):
+    # median absolute error of a metric against the ground truth of each voxel's tissue
+    import numpy as np
+    true_map = np.zeros(len(truth) + 1)
+    for label, tissue_truth in truth.items():
+        true_map[int(label)] = tissue_truth[metric]
+    brain = labels > 0
+    return float(np.nanmedian(np.abs(metric_map[brain] - true_map[labels[brain]])))
+
+
+def setup_benchmark(name, work_dir, n_jobs):
+    """
+    Import and load everything a benchmark needs. Returns a function that runs the benchmark, and a function (or
+    None) that checks what the run returned after it is timed, returning a dictionary of any results to record
+    (e.g. accuracy).
+    """
+    sys.path[:0] = script_dirs
+    import numpy as np
+    import nibabel as nib
+
+    dwi_dir = os.path.join(work_dir, 'dwi')
+    dwi, bval, bvec = [os.path.join(dwi_dir, 'sub-01_dwi' + x) for x in ['.nii.gz', '.bval', '.bvec']]
+    labels_file = os.path.join(dwi_dir, 'sub-01_labels.nii.gz')
+    mask_file = os.path.join(dwi_dir, 'sub-01_mask.nii.gz')
+    out_dir = os.path.join(work_dir, 'outputs')
+    os.makedirs(out_dir, exist_ok=True)
+
+    if name == 'extract_shells':
+        from extract_shells import extract_shells, shell_volumes
+        from dwi_utils import detect_shells
+
+        def run():
+            # b0 with each shell and all shells together (--auto)
+            return extract_shells(dwi, bval, bvec, threshold=50, out_dir=out_dir)
+
+        def check(out_files):
+            # every output must hold exactly the input volumes of its shells
+            data = nib.load(dwi).get_fdata()
+            bvals = np.loadtxt(bval)
+            for out_dwi, out_bval, _ in out_files:
+                keep = shell_volumes(bvals, detect_shells(np.loadtxt(out_bval, ndmin=1), 50), 50)
+                if not np.array_equal(nib.load(out_dwi).get_fdata(), data[..., keep]):
+                    raise ValueError('Volumes of ' + out_dwi + ' do not match the input DWI!')
+        return run, check
+
+    if name == 'smoothing':
+        from dwi_utils import smooth_volumes, fwhm_to_sigma
+        img = nib.load(dwi)
+        data = img.get_fdata(dtype=np.float32)
+
+        def run():
+            smooth_volumes(data, fwhm_to_sigma(1.25, img.header.get_zooms()), n_jobs)
+        return run, None
+
+    if name == 'median_otsu':
+        from dwi_utils import brain_mask
+        img = nib.load(dwi)
+        data = img.get_fdata()
+        true_mask = nib.load(mask_file).get_fdata() > 0
+
+        def run():
+            return brain_mask(img, dwi, data=data)
+
+        def check(mask):
+            # fraction of voxels where the extracted mask disagrees with the phantom's brain
+            return {'mask_error': float(np.mean(mask != true_mask))}
+        return run, check
+
+    if name in ['dki_fit', 'fwdti_fit']:
+        with open(os.path.join(dwi_dir, 'sub-01_truth.json')) as f:
+            truth = json.load(f)
+        labels = np.asanyarray(nib.load(labels_file).dataobj)
+        if name == 'dki_fit':
+            from process_dki import fit_dki, dki_model
+            model = dki_model(bval, bvec)
+            fit_function, metrics = fit_dki, ['FA', 'MK']
+        else:
+            from process_freewater_dti import fit_fwdti, fwdti_model
+            model = fwdti_model(bval, bvec)
+            fit_function, metrics = fit_fwdti, ['FA']
+
+        def run():
+            return fit_function(dwi, bval, bvec, mask=mask_file, metrics=metrics, n_jobs=n_jobs, model=model)
+
+        def check(maps):
+            return {x + '_error': tissue_error(maps[x], labels, truth, x) for x in metrics}
+        return run, check
+
+    if name == 'combine_rois':
+        from combine_rois import combine_rois
+        # every pair of tissues, and all tissues
+        region_groups = {str(x) + '_' + str(y): [x, y] for x in phantom_tissues for y in phantom_tissues if x < y}
+        region_groups['all'] = list(phantom_tissues)
+
+        def run():
+            combine_rois(labels_file, region_groups)
+        return run, None
+
+    if name == 'read_gif_csv':
+        from read_gif_csv import read_gif_volumes
+
+        def run():
+            read_gif_volumes(os.path.join(work_dir, 'gif'), 'volumeProb', n_jobs)
+        return run, None
+
+    if name == 'concatenate_csvs':
+        from concatenate_csvs import concatenate_csvs
+        csv_dir = os.path.join(work_dir, 'csvs')
+
+        def run():
+            concatenate_csvs(csv_dir, 'all_roi_metrics.csv', ends_with='_roi_metrics.csv', n_jobs=n_jobs)
+        return run, None
+
+    raise ValueError('Unknown benchmark: ' + name)
+
+
+def sample_worker_rss(worker_peaks, stop, interval=0.05):
+    """
+    Record the peak RSS (MB) of each child process of this process in worker_peaks (pid -> MB) every interval
+    seconds until stop is set (linux only).
+
+    ru_maxrss of children can't be used as it includes children that finished before the run (e.g. started by
+    imports). Workers forked during the run start from the peak of this process since it was reset.
+    """
+    pid = str(os.getpid())
+    checked = set()
+    workers = set()
+    while True:
+        # find new children, checking the parent of each process once
+        for process in os.listdir('/proc') if os.path.isdir('/proc') else []:
+            if not process.isdigit() or process in checked:
+                continue
+            checked.add(process)
+            try:
+                with open('/proc/' + process + '/stat') as f:
+                    # the parent pid follows the command name, which is in brackets and can contain spaces
+                    if f.read().rsplit(')', 1)[1].split()[1] == pid:
+                        workers.add(process)
+            except (OSError, IndexError):
+                # the process has finished
+                pass
+
+        for worker in list(workers):
+            try:
+                with open('/proc/' + worker + '/status') as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            worker_peaks[worker] = max(worker_peaks.get(worker, 0), int(line.split()[1]) / 1024)
+            except OSError:
+                workers.discard(worker)
+        if stop.wait(interval):
+            return
+
+
+def run_benchmark(name, work_dir, n_jobs):
+    """
+    Set up and run one benchmark in this process, measuring time and memory of the run only.
+    """
+    import threading
+    from instrumentation import peak_rss_mb, reset_peak_rss
+
+    run, check = setup_benchmark(name, work_dir, n_jobs)
+    # peak RSS from here on (ru_maxrss of a new process carries over the peak of the process that started it)
+    reset_peak_rss()
+    setup_rss = peak_rss_mb()
+    # peak RSS of worker processes started by the run (e.g. parallel fitting), which the peak of this process
+    # doesn't include
+    worker_peaks = {}
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=sample_worker_rss, args=(worker_peaks, stop_sampling))
+    sampler.start()
+    times_start = os.times()
+    t0 = time.perf_counter()
+    try:
+        run_output = run()
+    finally:
+        stop_sampling.set()
+        sampler.join()
+    wall_time = time.perf_counter() - t0
+    times_end = os.times()
+    peak_rss = peak_rss_mb()
+
+    # check the output (e.g. accuracy) once timing and memory are measured
+    results = (check(run_output) if check else None) or {}
+
+    results.update(wall_time=wall_time,
+                   cpu_time=sum(times_end[:4]) - sum(times_start[:4]),
+                   peak_rss_mb=peak_rss,
+                   peak_rss_increase_mb=peak_rss - setup_rss,
+                   peak_worker_rss_mb=max(worker_peaks.values(), default=0))
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Compare benchmark results to a baseline. Returns a list of regressions found.
+    """
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        base = baseline['benchmarks'][name]
+        # larger is worse for every measure, but differences smaller than timer/memory noise are ignored
+        for measure, value in result.items():
+            if measure not in base or not base[measure]:
+                continue
+            ratio = value / base[measure]
+            noise = 0.05 if measure.endswith('_time') else 5 if measure.endswith('_mb') else 1e-6
+            if value - base[measure] < noise:
+                continue
+            if ratio > 1 + tolerance:
+                regressions.append(name + ' ' + measure + ': ' + '{:.4g}'.format(value) + ' vs baseline ' +
+                                   '{:.4g}'.format(base[measure]) + ' (' + '{:.0%}'.format(ratio - 1) + ' worse)')
+    return regressions
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark_')
+    output = args.output or os.path.join(work_dir, 'benchmark_results.json')
+
+    sys.path[:0] = script_dirs
+    sys.path.append(repo_dir)
+    import numpy as np
+    import nibabel as nib
+    import dipy
+    import pandas as pd
+
+    # inputs are made in a separate process, so the memory of making them isn't part of this one (which starts
+    # every benchmark process)
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+        pool.submit(make_inputs, work_dir, args).result()
+
+    results = {'environment': {'python': platform.python_version(),
+                               'platform': platform.platform(),
+                               'cpu_count': os.cpu_count(),
+                               'numpy': np.__version__,
+                               'nibabel': nib.__version__,
+                               'dipy': dipy.__version__,
+                               'pandas': pd.__version__,
+                               'n_jobs': args.n_jobs,
+                               'created': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'phantom': phantom_settings(args),
+               'benchmarks': {}}
+
+    for name in args.benchmarks:
+        runs = []
+        for repeat in range(args.repeats):
+            # a fresh process for each run, so memory isn't shared between benchmarks
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+                runs.append(pool.submit(run_benchmark, name, work_dir, args.n_jobs).result())
+        results['benchmarks'][name] = min(runs, key=lambda x: x['wall_time'])
+        print(name + ': ' + ', '.join(k + '=' + '{:.4g}'.format(v) for k, v in results['benchmarks'][name].items()))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Benchmark results saved to: ' + output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['phantom'] != results['phantom']:
+            print('WARNING: baseline was run with different phantom settings: ' + json.dumps(baseline['phantom']))
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(str(len(regressions)) + ' regressions compared to ' + args.baseline + ':\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print('No regressions compared to ' + args.baseline)
+
+
+if __name__ == '__main__':
+    main()
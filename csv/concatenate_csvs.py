@@ -3,14 +3,35 @@
 
 # load packages
 import os
-import pandas as pd
+import sys
+import hashlib
+import importlib.util
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
 
 # get arguments
 __description__ = '''
 This script collates all csv's matching pattern and concatenates them into one long csv file.
 Each csv file is indexed by their filename. Each filename's full path must be unique!
 Tip: make each csv filename subject + measure specific and then clean the filename column afterwards to get those variables.
+
+Files are read in parallel and written to the output in batches, so memory use depends on --batch_size rather than
+the number of files. The output can be csv, parquet or feather (chosen by the --output extension). Parquet and feather
+outputs need pyarrow installed and store the Filename column as a categorical. Their column types come from the
+first batch, and a column whose type differs in a later batch (e.g. text in a column of numbers, or in a column no
+file of the first batch had) is saved as float (for a mix of numbers) or text instead, writing the output again.
+
+A manifest of each csv's path, size, modification time and hash is saved next to the output (output + .manifest.json).
+With --incremental, only csv files that are new or have changed since the manifest was saved are read. Rows from
+changed or deleted files are removed from the previous output and rows from new or changed files are added.
+
+csv files can also be collated from python with concatenate_csvs (importing this script with its directory on the
+python path), e.g. concatenate_csvs('/data/bids', 'all_roi_metrics.csv', ends_with='roi_metrics.csv')
 '''
 
 # collect inputs
@@ -27,42 +48,287 @@ parser.add_argument('-ew', '--ends_with',
                     required=False,
                     default='.csv')
 parser.add_argument('-o', '--output',
-                    help='Output csv file name with all data. Saved in parentdir.',
+                    help='Output file name with all data. Saved in parentdir. Ending in .parquet or .feather saves in '
+                         'that format, otherwise csv.',
                     required=False,
                     default='all_csv_data.csv')
-args = parser.parse_args()
+parser.add_argument('-n', '--n_jobs',
+                    help='Number of threads to read csv files with. Default is chosen by python from the CPU count.',
+                    required=False,
+                    type=int)
+parser.add_argument('-bs', '--batch_size',
+                    help='Number of csv files to read before writing them to the output. Default is 1000.',
+                    required=False,
+                    type=int,
+                    default=1000)
+parser.add_argument('-inc', '--incremental',
+                    help='Update the previous output using its manifest, only reading new or changed csv files. '
+                         'If there is no previous output or manifest, all files are read. Default is False.',
+                    required=False,
+                    action='store_true')
+add_run_log_args(parser)
+
+def read_csv_columns(icsv):
+    # read only the header of a csv file
+    import pandas as pd
+    return list(pd.read_csv(icsv, nrows=0).columns)
+
+
+def read_csv_file(icsv, columns):
+    # read each file into a dataframe
+    import pandas as pd
+    csv_df = pd.read_csv(icsv)
+    # put the file name as a column in the data frame
+    csv_df['Filename'] = icsv
+    # give every file the same columns so batches can be appended to the output
+    return csv_df.reindex(columns=columns)
+
+
+def csv_file_info(icsv, previous_info=None):
+    # size, modification time and hash of a csv file for the manifest
+    # the hash is only recalculated if size or modification time have changed
+    file_stat = os.stat(icsv)
+    info = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+    if previous_info and previous_info['size'] == info['size'] and previous_info['mtime'] == info['mtime']:
+        info['sha256'] = previous_info['sha256']
+    else:
+        with open(icsv, 'rb') as f:
+            info['sha256'] = hashlib.sha256(f.read()).hexdigest()
+    return info
+
+
+def read_output_batches(out_file, out_format, drop_files):
+    # read a previous output a batch at a time, removing rows from files in drop_files
+    import pandas as pd
+    if out_format == '.parquet':
+        import pyarrow.parquet as pq
+    elif out_format == '.feather':
+        import pyarrow as pa
+    if out_format == '.parquet':
+        out_batches = (x.to_pandas() for x in pq.ParquetFile(out_file).iter_batches())
+    elif out_format == '.feather':
+        reader = pa.ipc.open_file(out_file)
+        out_batches = (reader.get_batch(i).to_pandas() for i in range(reader.num_record_batches))
+    else:
+        out_batches = pd.read_csv(out_file, chunksize=100000)
+    for out_batch in out_batches:
+        yield out_batch[~out_batch['Filename'].isin(drop_files)]
+
+
+def read_csv_batches(csv_files, columns, pool, batch_size):
+    # read files in parallel a batch at a time
+    import pandas as pd
+    for ibatch in range(0, len(csv_files), batch_size):
+        yield pd.concat(pool.map(partial(read_csv_file, columns=columns), csv_files[ibatch:ibatch + batch_size]),
+                        ignore_index=True)
+        print('Read ' + str(min(ibatch + batch_size, len(csv_files))) + ' of ' + str(len(csv_files)) + ' files')
+
+
+class ColumnTypeError(ValueError):
+    # a column of a batch can't be saved with the type the output's schema has for it (e.g. text in a column that
+    # was numbers, or all empty, in the first batch), and the type that holds both
+    def __init__(self, column, column_type):
+        super().__init__('Column ' + column + ' has mixed types, it needs saving as ' + str(column_type))
+        self.column = column
+        self.column_type = column_type
+
+
+def promote_type(out_type, batch_type):
+    # type that holds values of both types - float for a mix of numbers, otherwise text
+    import pyarrow as pa
+    if all(pa.types.is_integer(x) or pa.types.is_floating(x) for x in [out_type, batch_type]):
+        return pa.float64()
+    return pa.string()
+
 
-# get list of csvs
-dir_list = []
-indir = os.path.abspath(args.parent_dir)
+def write_batches(out_file, out_format, csv_batches, columns, column_types=None):
+    # append each batch of rows to the output in turn
+    # parquet and feather column types come from the first batch, apart from any in column_types
+    import pandas as pd
+    if out_format in ['.parquet', '.feather']:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    writer = None
+    n_written = 0
+    # empty batches are skipped so the first batch with data sets the column types,
+    # unless there is no data at all when an empty output is saved
+    for csv_batch in chain((x for x in csv_batches if not x.empty), [pd.DataFrame(columns=columns)]):
+        if n_written and csv_batch.empty:
+            break
+        csv_batch = csv_batch.reindex(columns=columns)
+        # filenames repeat for every row of a file, so store them as a categorical
+        csv_batch['Filename'] = csv_batch['Filename'].astype('category')
 
-if args.sub_dir:
-    print('Subdirectory defined - only extracting csv files under this subdirectory:' + str(args.sub_dir))
-    for root, dirs, files in os.walk(indir):
-        if args.sub_dir in root:
+        if out_format in ['.parquet', '.feather']:
+            batch_table = pa.Table.from_pandas(csv_batch, preserve_index=False)
+            if writer is None:
+                # use the first batch's column types for the whole file
+                # feather can't change categories between batches, so filenames are saved as strings
+                filename_type = pa.dictionary(pa.int32(), pa.string()) if out_format == '.parquet' else pa.string()
+                out_schema = batch_table.schema.remove_metadata()
+                out_schema = out_schema.set(out_schema.get_field_index('Filename'), pa.field('Filename', filename_type))
+                for column, column_type in (column_types or {}).items():
+                    out_schema = out_schema.set(out_schema.get_field_index(column), pa.field(column, column_type))
+                if out_format == '.parquet':
+                    writer = pq.ParquetWriter(out_file, out_schema)
+                else:
+                    writer = pa.ipc.new_file(out_file, out_schema)
+            try:
+                batch_table = batch_table.cast(out_schema)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                writer.close()
+                # find the column that can't be cast
+                for field in out_schema:
+                    try:
+                        batch_table.column(field.name).cast(field.type)
+                    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                        raise ColumnTypeError(field.name,
+                                              promote_type(field.type, batch_table.schema.field(field.name).type))
+                raise
+            writer.write_table(batch_table)
+        else:
+            csv_batch.to_csv(out_file, mode='w' if n_written == 0 else 'a', header=n_written == 0, index=False)
+        n_written += 1
+
+    if writer is not None:
+        writer.close()
+
+
+def write_output(out_file, out_format, make_batches, columns):
+    # write the batches from make_batches(), starting again with a type that holds both for any column whose
+    # type changes between files, so the first batch's types don't have to suit every file
+    column_types = {}
+    while True:
+        try:
+            write_batches(out_file, out_format, make_batches(), columns, column_types)
+            return
+        except ColumnTypeError as e:
+            if column_types.get(e.column) == e.column_type:
+                raise
+            print(str(e) + ', writing the output again')
+            column_types[e.column] = e.column_type
+
+
+def read_output_columns(out_file, out_format):
+    # column names of a previous output
+    if out_format == '.parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(out_file).names
+    elif out_format == '.feather':
+        import pyarrow as pa
+        return pa.ipc.open_file(out_file).schema.names
+    import pandas as pd
+    return list(pd.read_csv(out_file, nrows=0).columns)
+
+
+def concatenate_csvs(parent_dir, output='all_csv_data.csv', sub_dir=None, ends_with='.csv', n_jobs=None,
+                     batch_size=1000, incremental=False):
+    """
+    Collate csv files under parent_dir ending with ends_with into one output file in parent_dir, as the command
+    line does.
+
+    Returns the output filename.
+    """
+    # get list of csvs
+    dir_list = []
+    indir = os.path.abspath(parent_dir)
+
+    if sub_dir:
+        print('Subdirectory defined - only extracting csv files under this subdirectory:' + str(sub_dir))
+        for root, dirs, files in os.walk(indir):
+            if sub_dir in root:
+                for ifile in files:
+                    if ifile.endswith(str(ends_with)):
+                        print(os.path.join(root, ifile))
+                        dir_list.append(os.path.join(root, ifile))
+    else:
+        print('Extracting all csv files under parent directory' + str(parent_dir))
+        for root, dirs, files in os.walk(indir):
             for ifile in files:
-                if ifile.endswith(str(args.ends_with)):
+                if ifile.endswith(str(ends_with)):
                     print(os.path.join(root, ifile))
                     dir_list.append(os.path.join(root, ifile))
-else:
-    print('Extracting all csv files under parent directory' + str(args.parent_dir))
-    for root, dirs, files in os.walk(indir):
-        for ifile in files:
-            if ifile.endswith(str(args.ends_with)):
-                print(os.path.join(root, ifile))
-                dir_list.append(os.path.join(root, ifile))
-
-
-# loop through and create nested dictionaries of dfs
-csv_dict = {}
-for icsv in dir_list:
-    # read each file into a dataframe
-    csv_dict[icsv] = pd.read_csv(icsv)
-    # put the file name as a column in the data frame
-    csv_dict[icsv]['Filename'] = icsv
 
-# concatenate all files into one dataframe
-csv_all = pd.concat(csv_dict.values(), ignore_index=True)
+    # choose output format from the file extension
+    out_file = os.path.join(parent_dir, output)
+    out_format = os.path.splitext(out_file)[1].lower()
+    manifest_file = out_file + '.manifest.json'
+    if out_format in ['.parquet', '.feather'] and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError('pyarrow is needed to save ' + out_format + ' files. Install it or save as .csv')
+
+    # don't collate a previous output
+    dir_list = [x for x in dir_list if os.path.abspath(x) != os.path.abspath(out_file)]
+    if not dir_list:
+        raise ValueError('No csv files found ending with ' + str(ends_with))
+
+    # load manifest of files in the previous output
+    previous_manifest = {}
+    if incremental:
+        if os.path.exists(manifest_file) and os.path.exists(out_file):
+            with open(manifest_file) as f:
+                previous_manifest = json.load(f)
+        else:
+            print('No previous output and manifest found, reading all csv files')
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        # compare files to the previous manifest to find which need reading
+        with stage('manifest'):
+            manifest = dict(zip(dir_list, pool.map(lambda x: csv_file_info(x, previous_manifest.get(x)), dir_list)))
+        read_files = [x for x in dir_list if x not in previous_manifest or
+                      manifest[x]['sha256'] != previous_manifest[x]['sha256']]
+        drop_files = [x for x in previous_manifest if x not in manifest or x in read_files]
+
+        if previous_manifest:
+            print(str(len(read_files)) + ' new or changed csv files, ' +
+                  str(len(set(previous_manifest) - set(manifest))) + ' deleted csv files')
+            if not read_files and not drop_files:
+                print('Nothing to update in: ' + out_file)
+
+        if read_files or drop_files or not previous_manifest:
+            # all columns found in any csv, in the order they first appear, with the file name last
+            all_columns = []
+            with stage('columns'):
+                if previous_manifest:
+                    all_columns.extend(x for x in read_output_columns(out_file, out_format) if x != 'Filename')
+                for csv_columns in pool.map(read_csv_columns, read_files):
+                    all_columns.extend(x for x in csv_columns if x not in all_columns and x != 'Filename')
+                all_columns.append('Filename')
+
+            # reading and writing are interleaved a batch at a time, so are measured together
+            with stage('collate'):
+                if previous_manifest:
+                    # rows kept from the previous output, then rows from new or changed files
+                    # written to a temporary file first as the previous output is read while writing
+                    tmp_out_file = os.path.splitext(out_file)[0] + '.tmp' + out_format
+                    write_output(tmp_out_file, out_format,
+                                 lambda: chain(read_output_batches(out_file, out_format, drop_files),
+                                               read_csv_batches(read_files, all_columns, pool, batch_size)),
+                                 all_columns)
+                    os.replace(tmp_out_file, out_file)
+                else:
+                    write_output(out_file, out_format,
+                                 lambda: read_csv_batches(read_files, all_columns, pool, batch_size),
+                                 all_columns)
+
+    # save manifest for incremental updates
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    print('All csv data saved to: ' + out_file)
+    return out_file
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    with record_run('concatenate_csvs', args, args.parent_dir):
+        concatenate_csvs(args.parent_dir,
+                         output=args.output,
+                         sub_dir=args.sub_dir,
+                         ends_with=args.ends_with,
+                         n_jobs=args.n_jobs,
+                         batch_size=args.batch_size,
+                         incremental=args.incremental)
+
 
-# save to output csv
-csv_all.to_csv(os.path.join(args.parent_dir, args.output), index=False)
+if __name__ == '__main__':
+    main()
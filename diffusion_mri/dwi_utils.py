@@ -0,0 +1,678 @@
+"""
+Helper functions shared by the diffusion MRI scripts in this directory.
+
+Scripts import these directly (e.g. from dwi_utils import fit_slabwise), which works when the scripts are
+run as python /path/to/script.py because the script's own directory is on the python path.
+
+nibabel, dipy and scipy are imported inside the functions that use them, so importing this module (and the
+scripts' --help) stays fast.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+import hashlib
+import json
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks (windows), so cache entries in use by other processes can be evicted
+    fcntl = None
+
+# state attached in each worker process by _init_worker
+_worker_model = None
+_worker_shm = None
+_worker_voxels = None
+
+
+def load_volumes(img, vol_idx, dtype=np.float64):
+    """
+    Read only the requested volumes of a 4D image through the nibabel data proxy.
+
+    Returns an array of shape (x, y, z, len(vol_idx)), the same values get_fdata(dtype=dtype) would give.
+    """
+    return np.stack([np.asarray(img.dataobj[..., v], dtype=dtype) for v in vol_idx], axis=-1)
+
+
+def file_hash(filename):
+    """
+    sha256 hex digest of a file's contents, read in blocks so large images aren't held in memory.
+    """
+    file_sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 24), b''):
+            file_sha.update(block)
+    return file_sha.hexdigest()
+
+
+def lock_file(f, exclusive=False, wait=True):
+    """
+    Take an advisory lock on an open file, shared (a cache entry in use) or exclusive (a cache entry being removed),
+    held until the file is closed. Returns False if wait is False and another process holds a conflicting lock, and
+    always True where locks aren't available.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if wait else fcntl.LOCK_NB))
+    except BlockingIOError:
+        return False
+    return True
+
+
+def open_locked(filename):
+    """
+    Open a cache entry with a shared lock, so evict_lru in other processes leaves it alone until the returned file
+    is closed. Returns None if the entry doesn't exist (or was evicted while waiting for the lock).
+    """
+    try:
+        f = open(filename, 'rb')
+    except FileNotFoundError:
+        return None
+    lock_file(f)
+    try:
+        if os.path.samestat(os.fstat(f.fileno()), os.stat(filename)):
+            return f
+    except FileNotFoundError:
+        pass
+    f.close()
+    return None
+
+
+def remove_unused(filename):
+    """
+    Remove a cache entry unless another process holds it open with open_locked, or has already removed it.
+    """
+    try:
+        if fcntl is None:
+            os.remove(filename)
+            return
+        with open(filename, 'rb') as f:
+            # the entry could have been replaced by a new file since it was opened
+            if lock_file(f, exclusive=True, wait=False) and \
+                    os.path.samestat(os.fstat(f.fileno()), os.stat(filename)):
+                os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def evict_lru(cache_dir, max_size, suffix, keep=None):
+    """
+    Delete the least recently used files ending with suffix in cache_dir until they total under max_size GB.
+
+    Use is tracked by modification time, so cache reads should os.utime the file. keep is never deleted, nor are
+    entries other processes are using (see open_locked). The cache can be shared by processes running at the same
+    time, so entries removed by another process are skipped.
+    """
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith(suffix):
+            try:
+                entries.append((os.stat(os.path.join(cache_dir, f)), os.path.join(cache_dir, f)))
+            except FileNotFoundError:
+                pass
+    entries.sort(key=lambda x: x[0].st_mtime, reverse=True)
+    total = 0
+    for entry_stat, entry in entries:
+        total += entry_stat.st_size
+        if total > max_size * 1024 ** 3 and entry != keep:
+            remove_unused(entry)
+
+
+def mask_cache_key(dwi_file, **params):
+    """
+    Key for a brain mask in the mask cache: a hash of the DWI file contents and the masking parameters.
+
+    Changing the DWI or any parameter gives a new key, so a cached mask is never out of date - entries are
+    never overwritten, only removed by evict_lru when the cache is full.
+    """
+    return hashlib.sha256((file_hash(dwi_file) + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+
+
+def load_cached_mask(cache_dir, key):
+    """
+    Load a boolean brain mask from the mask cache, or return None if it isn't cached.
+    """
+    filename = os.path.join(cache_dir, key + '_mask.nii.gz')
+    import nibabel as nib
+    try:
+        os.utime(filename)  # mark as recently used
+        return np.asanyarray(nib.load(filename).dataobj) != 0
+    except FileNotFoundError:
+        # not cached, or evicted by another process
+        return None
+
+
+def save_cached_mask(cache_dir, key, mask, affine, max_size):
+    """
+    Save a brain mask to the mask cache, then shrink the cache to max_size GB.
+    """
+    import nibabel as nib
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, key + '_mask.nii.gz')
+    # write to a temporary file first so other processes never read a partly written mask
+    tmp_filename = os.path.join(cache_dir, key + '_' + str(os.getpid()) + '_tmp.nii.gz')
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine), tmp_filename)
+    os.replace(tmp_filename, filename)
+    evict_lru(cache_dir, max_size, '_mask.nii.gz', keep=filename)
+
+
+def brain_mask(img, dwi_file, mask=None, data=None, smooth_fwhm=None, mask_cache=None, mask_cache_size=1,
+               dtype=np.float64):
+    """
+    Boolean brain mask of a DWI to fit a model within.
+
+    mask: mask nifti filename or array. If not given, dipy's median_otsu brain extraction is run on the first two
+        volumes of data, or if data isn't loaded (None) just those volumes are read from img (and smoothed in float32
+        if smooth_fwhm is given, as when fitting).
+    mask_cache, mask_cache_size: directory and maximum size (GB) of a cache of extracted masks (see mask_cache_key)
+    dtype: data type to read volumes for brain extraction in, if not smoothing
+    """
+    if mask is not None:
+        if isinstance(mask, str):
+            import nibabel as nib
+            print("Mask specified, loading mask: " + mask)
+            mask = nib.load(mask).get_fdata()
+        # create boolean mask
+        return np.asarray(mask) != 0
+
+    if mask_cache:
+        mask_params = dict(vol_idx=[0, 1], median_radius=4, numpass=2, dilate=1, smooth_fwhm=smooth_fwhm)
+        if np.dtype(dtype) != np.float64:
+            # keys of float64 masks are unchanged from before precision was an option
+            mask_params['precision'] = np.dtype(dtype).name
+        mask_key = mask_cache_key(dwi_file, **mask_params)
+        cached_mask = load_cached_mask(mask_cache, mask_key)
+        if cached_mask is not None:
+            print("Mask not specified, using cached dipy brain extraction from: " + mask_cache)
+            return cached_mask
+
+    from dipy.segment.mask import median_otsu
+    print("Mask not specified, running dipy brain extraction...")
+    if data is None:
+        # only the volumes used for brain extraction are needed
+        if smooth_fwhm:
+            data = smooth_volumes(load_volumes(img, [0, 1], np.float32),
+                                  fwhm_to_sigma(smooth_fwhm, img.header.get_zooms()))
+        else:
+            data = load_volumes(img, [0, 1], dtype)
+    maskdata, mask = median_otsu(data, vol_idx=[0, 1], median_radius=4, numpass=2, autocrop=False, dilate=1)
+    if mask_cache:
+        save_cached_mask(mask_cache, mask_key, mask, img.affine, mask_cache_size)
+    return mask
+
+
+def load_dwi(dwi_file, dwi_cache=None, dwi_cache_size=20):
+    """
+    Load a DWI with nibabel, through a cache of decompressed DWIs if dwi_cache is given.
+
+    A compressed DWI (.nii.gz, .nii.bz2 or .nii.zst) is decompressed once into dwi_cache as an uncompressed .nii named
+    by the sha256 of the compressed file's contents, so it is never out of date. Later loads (by any script) memory
+    map that file instead, so reading volumes, slabs or the whole image doesn't decompress the DWI again. Least
+    recently used DWIs are removed to keep the cache under dwi_cache_size GB. Uncompressed DWIs are loaded directly.
+
+    The returned image's filename is the cached file, so name outputs after dwi_file (e.g. with output_prefix).
+    The cached file is locked while the image exists (see open_locked), as reading slabs reopens it, so other
+    processes sharing the cache don't evict it while it is in use.
+    """
+    import nibabel as nib
+    if not dwi_cache or not dwi_file.endswith(('.nii.gz', '.nii.bz2', '.nii.zst')):
+        return nib.load(dwi_file)
+
+    cached_file = os.path.join(dwi_cache, file_hash(dwi_file) + '_dwi.nii')
+    cache_lock = open_locked(cached_file)
+    if cache_lock is not None:
+        print("Using decompressed DWI from cache: " + cached_file)
+        os.utime(cached_file)  # mark as recently used
+    else:
+        import shutil
+        from nibabel.openers import ImageOpener
+        print("Decompressing DWI into cache: " + cached_file)
+        os.makedirs(dwi_cache, exist_ok=True)
+        # write to a temporary file first so other processes never read a partly written DWI
+        tmp_file = os.path.join(dwi_cache, os.path.basename(cached_file)[:-len('_dwi.nii')] + '_' + str(os.getpid()) +
+                                '_tmp.nii')
+        with ImageOpener(dwi_file, 'rb') as fin, open(tmp_file, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 2 ** 24)
+        # locked before it is in the cache, so it can't be evicted before it is used
+        cache_lock = open(tmp_file, 'rb')
+        lock_file(cache_lock)
+        os.replace(tmp_file, cached_file)
+        evict_lru(dwi_cache, dwi_cache_size, '_dwi.nii', keep=cached_file)
+    # copy-on-write memory map, so in-place changes to the data (e.g. smoothing) never reach the cache
+    img = nib.load(cached_file, mmap='c')
+    # the lock is released when the image is garbage collected
+    img._dwi_cache_lock = cache_lock
+    return img
+
+
+def load_gtab(bval, bvec):
+    """
+    Read FSL style .bval and .bvec files into a dipy gradient table.
+    """
+    from dipy.io.gradients import read_bvals_bvecs
+    from dipy.core.gradients import gradient_table
+    bvals, bvecs = read_bvals_bvecs(bval, bvec)
+    return gradient_table(bvals, bvecs=bvecs)
+
+
+def output_prefix(dwi_file, out_dir=None):
+    """
+    Prefix of output files for a DWI: its path without extensions (e.g. /data/sub-01_dwi for /data/sub-01_dwi.nii.gz),
+    in out_dir instead of the DWI's directory if given.
+    """
+    return os.path.join(out_dir or os.path.dirname(dwi_file), os.path.basename(dwi_file).split('.')[0])
+
+
+def detect_shells(bvals, threshold=0):
+    """
+    Group b-values into shells. Sorted b-values further apart than threshold start a new shell.
+
+    A group can be wider than threshold either side of its median (e.g. 0, 5, 10, 15, 20 with threshold 5), when
+    shell_volumes wouldn't select all of its volumes - check with shell_volumes(bvals, shells, threshold).all().
+
+    Returns a sorted list of shell b-values (the rounded median of each group).
+    """
+    sorted_bvals = np.sort(bvals)
+    groups = np.split(sorted_bvals, np.flatnonzero(np.diff(sorted_bvals) > threshold) + 1)
+    return [int(np.round(np.median(group))) for group in groups]
+
+
+def split_volumes(img, outputs):
+    """
+    Write subsets of volumes of a 4D NIfTI image to new files (.nii or .nii.gz) from one pass over the input.
+
+    outputs: dictionary of output filename -> volume indices to keep (in increasing order)
+
+    The input is read sequentially one volume at a time, so a compressed input is decompressed only once
+    however many outputs are written. NIfTI stores data in Fortran order, so each volume is a contiguous block
+    that is copied to every output that keeps it in its on-disk dtype with the original header scaling.
+    Only one volume is held in memory.
+
+    Offsets and scaling are taken from the image's data proxy, as nibabel resets them in img.header on loading.
+    """
+    from nibabel.openers import ImageOpener
+    from nibabel.volumeutils import array_from_file, array_to_file, seek_tell
+    vol_shape = img.shape[:3]
+    dtype = img.header.get_data_dtype()
+    vol_bytes = int(np.prod(vol_shape)) * dtype.itemsize
+    in_offset = img.dataobj.offset
+    keep = {filename: set(vol_idx) for filename, vol_idx in outputs.items()}
+
+    with ExitStack() as stack:
+        fin = stack.enter_context(ImageOpener(img.get_filename(), 'rb'))
+        fouts = {}
+        for filename, vol_idx in outputs.items():
+            hdr = img.header.copy()
+            hdr.set_data_shape(vol_shape + (len(vol_idx),))
+            # same header and extensions as the input, so the data starts at the same offset
+            hdr.set_data_offset(in_offset)
+            hdr.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+            fouts[filename] = stack.enter_context(ImageOpener(filename, 'wb'))
+            hdr.write_to(fouts[filename])
+            seek_tell(fouts[filename], hdr.get_data_offset(), write0=True)
+
+        for v in sorted(set().union(*keep.values())):
+            vol = array_from_file(vol_shape, dtype, fin, offset=in_offset + v * vol_bytes, mmap=False)
+            for filename, fout in fouts.items():
+                if v in keep[filename]:
+                    array_to_file(vol, fout, dtype, offset=None)
+
+
+def fwhm_to_sigma(fwhm, zooms):
+    """
+    Convert a gaussian FWHM in mm to a standard deviation in voxels for each spatial axis.
+
+    zooms: voxel sizes in mm (e.g. img.header.get_zooms()), only the first 3 are used.
+    """
+    return tuple(fwhm / np.sqrt(8 * np.log(2)) / np.asarray(zooms[:3], dtype=float))
+
+
+def smooth_volumes(data, sigma, n_threads=None):
+    """
+    Smooth each volume of a 4D floating point array in place with a 3D gaussian kernel.
+
+    sigma: standard deviation in voxels, either one value or one per spatial axis (see fwhm_to_sigma).
+    Data is never smoothed along the volume axis. Volumes are independent and scipy releases the GIL while
+    filtering, so they are spread over n_threads threads, by default one per volume up to the number of CPUs. Only
+    one extra volume per thread is allocated.
+
+    Returns data, which has been smoothed in place.
+    """
+    from scipy.ndimage import gaussian_filter
+
+    def smooth(v):
+        vol = np.ascontiguousarray(data[..., v])
+        gaussian_filter(vol, sigma=sigma, output=vol)
+        data[..., v] = vol
+
+    with ThreadPoolExecutor(max_workers=n_threads or min(data.shape[-1], os.cpu_count())) as pool:
+        list(pool.map(smooth, range(data.shape[-1])))
+    return data
+
+
+def save_maps(maps, affine, out_prefix, dtype=np.float64, compress_level=1, single_file=None, n_threads=None):
+    """
+    Save 3D maps as NIfTI files named out_prefix + '_' + name, writing them concurrently from a thread pool
+    (gzip compression releases the GIL) of n_threads threads, by default one per file up to the number of CPUs.
+
+    maps: dictionary of name (e.g. 'DKI_MK') -> 3D array
+    dtype: data type to save maps as
+    compress_level: gzip compression level (1-9) for .nii.gz files, or 0 to save uncompressed .nii files. The level
+        is only used for these files, other nibabel saves keep nibabel's default.
+    single_file: if given, maps are instead stacked into one 4D file named out_prefix + '_' + single_file, with
+        volumes in the order of maps. The volume names are stored in the header description.
+
+    Returns a list of the saved filenames.
+    """
+    import nibabel as nib
+    from nibabel.openers import ImageOpener
+    ext = '.nii' if compress_level == 0 else '.nii.gz'
+    opener_args = {'compresslevel': compress_level} if compress_level else {}
+
+    if single_file:
+        packed_img = nib.Nifti1Image(np.stack([np.asarray(m, dtype=dtype) for m in maps.values()], axis=-1), affine)
+        packed_img.header['descrip'] = ','.join(maps)[:79]
+        images = {single_file: (out_prefix + '_' + single_file + ext, packed_img)}
+    else:
+        images = {name: (out_prefix + '_' + name + ext, nib.Nifti1Image(np.asarray(m, dtype=dtype), affine))
+                  for name, m in maps.items()}
+
+    def save(image):
+        # open the file here to set its compression level, rather than nibabel's default for every file
+        filename, img = image
+        with ImageOpener(filename, 'wb', **opener_args) as f:
+            img.to_file_map(img.make_file_map({'image': f}))
+
+    with ThreadPoolExecutor(max_workers=n_threads or min(len(images), os.cpu_count())) as pool:
+        list(pool.map(save, images.values()))
+
+    for name, (filename, _) in images.items():
+        print(name + " saved to: " + filename)
+    return [filename for filename, _ in images.values()]
+
+
+def smoothing_margin(sigma):
+    """
+    Number of voxels either side of each voxel that gaussian_filter with this sigma reaches, for each spatial axis.
+    """
+    # default truncate=4 standard deviations
+    return tuple(int(4.0 * x + 0.5) for x in np.broadcast_to(sigma, 3))
+
+
+def mask_bbox(mask, margin=0):
+    """
+    Bounding box of a 3D mask as a tuple of slices, grown by margin voxels either side (one value or one per axis)
+    but kept within the image.
+    """
+    if not mask.any():
+        raise ValueError('Mask is empty!')
+    bbox = []
+    for axis, axis_margin in enumerate(np.broadcast_to(margin, 3)):
+        found = np.flatnonzero(mask.any(axis=tuple(x for x in range(3) if x != axis)))
+        bbox.append(slice(max(found[0] - axis_margin, 0), min(found[-1] + 1 + axis_margin, mask.shape[axis])))
+    return tuple(bbox)
+
+
+def block_average(data, factor):
+    """
+    Downsample the first three axes of an array by averaging blocks of factor x factor x factor voxels.
+
+    Voxels left over at the far edge of an axis (when its size isn't a multiple of factor) are dropped.
+    """
+    shape = tuple(x // factor for x in data.shape[:3])
+    if 0 in shape:
+        raise ValueError('Image is smaller than a block of ' + str(factor) + ' voxels!')
+    data = data[:shape[0] * factor, :shape[1] * factor, :shape[2] * factor]
+    return data.reshape((shape[0], factor, shape[1], factor, shape[2], factor) + data.shape[3:]).mean(axis=(1, 3, 5))
+
+
+def preview_affine(affine, factor):
+    """
+    Affine of an image downsampled with block_average, placing each new voxel at the centre of the block it averages.
+    """
+    block_to_voxel = np.diag([factor, factor, factor, 1.0])
+    block_to_voxel[:3, 3] = (factor - 1) / 2
+    return affine @ block_to_voxel
+
+
+def downsample_image(img, factor, dtype=np.float64):
+    """
+    Low resolution copy of a 4D image for quick previews, block averaged (see block_average) one volume at a time.
+
+    The image is read once in its stored data type (or as a memory map for uncompressed files), so only one volume
+    is converted to dtype at a time. Returns an in-memory nibabel image with voxel sizes factor times larger.
+    """
+    import nibabel as nib
+    raw_data = np.asanyarray(img.dataobj)
+    data = np.stack([block_average(np.asarray(raw_data[..., v], dtype=dtype), factor)
+                     for v in range(raw_data.shape[3])], axis=-1)
+    return nib.Nifti1Image(data, preview_affine(img.affine, factor))
+
+
+def downsample_mask(mask, factor):
+    """
+    Downsample a 3D mask to the grid of downsample_image. A block is in the mask if at least half of its voxels are.
+    """
+    return block_average((np.asarray(mask) != 0).astype(np.float32), factor) >= 0.5
+
+
+def select_slices(mask, n_slices):
+    """
+    Restrict a 3D mask to n_slices evenly spaced slices (along the third axis) through the extent of the mask, e.g.
+    to only fit a few representative slices. The first and last slices of the mask are avoided.
+    """
+    z_extent = mask_bbox(mask)[2]
+    keep = np.unique(np.linspace(z_extent.start, z_extent.stop - 1, n_slices + 2).round().astype(int)[1:-1])
+    print("Fitting slices " + ', '.join(str(z) for z in keep) + " only")
+    slice_mask = np.zeros_like(mask)
+    slice_mask[:, :, keep] = mask[:, :, keep]
+    return slice_mask
+
+
+def fit_cropped(model, img, mask, fit_class, smooth_sigma=None, n_jobs=1, dtype=np.float64):
+    """
+    Fit a dipy model to only the bounding box of mask, reading just that sub-volume of the DWI from disk.
+
+    Memory and smoothing/fitting time scale with the size of the brain rather than the field of view.
+    If smooth_sigma is given, the box is read with a margin for smoothing (in float32, see smooth_volumes) so
+    smoothing matches smoothing the whole image. The fitted parameters are pasted into a full-size parameter array
+    (0 outside the box, as outside the mask when fitting the whole image), so metrics from the returned fit are
+    the same shape as the DWI and identical to fitting the whole image. Otherwise the box is read in dtype.
+    """
+    fit_box = mask_bbox(mask)
+    if smooth_sigma is not None:
+        read_box = mask_bbox(mask, smoothing_margin(smooth_sigma))
+        data = smooth_volumes(np.asarray(img.dataobj[read_box], dtype=np.float32), smooth_sigma)
+        data = data[tuple(slice(f.start - r.start, f.stop - r.start) for f, r in zip(fit_box, read_box))]
+    else:
+        data = np.asarray(img.dataobj[fit_box], dtype=dtype)
+    print("Fitting within mask bounding box of " + 'x'.join(str(x) for x in data.shape[:3]) + " voxels")
+
+    cropped_fit = fit_model(model, data, mask[fit_box], fit_class, n_jobs)
+    params = np.zeros(mask.shape + cropped_fit.model_params.shape[3:])
+    params[fit_box] = cropped_fit.model_params
+    return fit_class(model, params)
+
+
+def slab_thickness(img_shape, memory_limit, n_params, itemsize=8):
+    """
+    Number of slices (along the third axis) that can be fitted at once within memory_limit GB.
+
+    This is a rough estimate - each voxel holds the signal (itemsize bytes per value), a working copy of it
+    (smoothing/fitting) and n_params float64 model parameters. At least one slice is always returned.
+    """
+    bytes_per_slice = img_shape[0] * img_shape[1] * (2 * img_shape[3] * itemsize + n_params * 8)
+    n_slices = int(memory_limit * 1024 ** 3 // bytes_per_slice)
+    return int(np.clip(n_slices, 1, img_shape[2]))
+
+
+def _init_worker(model, shm_name, shape, dtype):
+    global _worker_model, _worker_shm, _worker_voxels
+    _worker_model = model
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_voxels = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+
+
+def _fit_chunk(start, stop):
+    return _worker_model.fit(_worker_voxels[start:stop]).model_params
+
+
+def fit_parallel(model, data, mask, n_jobs):
+    """
+    Fit a dipy model to the masked voxels of data in n_jobs worker processes.
+
+    Masked voxels are copied once into shared memory so the 4D array is not pickled to each worker. They are
+    split into balanced chunks (several per worker so slow voxels don't leave workers idle), fitted, and the
+    parameters put back in place. Every voxel is fitted independently, so the parameters are identical to
+    model.fit(data, mask=mask).
+
+    Returns an array of model parameters with shape data.shape[:-1] + (n_params,), 0 outside the mask.
+    """
+    voxels = data[mask]
+    shm = shared_memory.SharedMemory(create=True, size=max(voxels.nbytes, 1))
+    try:
+        shared_voxels = np.ndarray(voxels.shape, dtype=voxels.dtype, buffer=shm.buf)
+        shared_voxels[:] = voxels
+        del voxels
+
+        bounds = np.linspace(0, shared_voxels.shape[0], n_jobs * 4 + 1).astype(int)
+        chunks = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+        # fork so workers don't re-run the calling script on start up
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('fork'),
+                                 initializer=_init_worker,
+                                 initargs=(model, shm.name, shared_voxels.shape, shared_voxels.dtype)) as pool:
+            chunk_params = list(pool.map(_fit_chunk, *zip(*chunks)))
+        del shared_voxels
+    finally:
+        shm.close()
+        shm.unlink()
+
+    params = np.zeros(mask.shape + (chunk_params[0].shape[-1],))
+    params[mask] = np.concatenate(chunk_params)
+    return params
+
+
+def fit_model(model, data, mask, fit_class, n_jobs=1):
+    """
+    Fit a dipy model within mask, in n_jobs worker processes if n_jobs > 1.
+
+    fit_class is the fit object of the model (e.g. dki.DiffusionKurtosisFit). The parameters of serial and parallel
+    fits are both wrapped in it, so metrics are computed the same way (and are identical) whatever n_jobs is - some
+    models' serial fits (e.g. fwDTI) otherwise return a MultiVoxelFit, which computes metrics voxel by voxel.
+    """
+    if n_jobs > 1 and mask.any():
+        return fit_class(model, fit_parallel(model, data, mask, n_jobs))
+    return fit_class(model, model.fit(data, mask=mask).model_params)
+
+
+def open_params(params_file, shape):
+    """
+    Create a memory-mapped .npy file of zeros to write model parameters into (e.g. slab by slab).
+    """
+    return np.lib.format.open_memmap(params_file, mode='w+', dtype=np.float64, shape=shape)
+
+
+def save_params(params_file, params, **provenance):
+    """
+    Save fitted model parameters to a .npy file, and how they were fitted (provenance) to a .json file of the
+    same name, so more metrics can be derived later without refitting (see load_params).
+
+    params can be a memory map from open_params, which is flushed rather than written again.
+    """
+    import dipy
+    if isinstance(params, np.memmap):
+        params.flush()
+    else:
+        np.save(params_file, params)
+    provenance.update(shape=list(params.shape),
+                      dipy_version=dipy.__version__,
+                      created=datetime.now().isoformat(timespec='seconds'))
+    with open(os.path.splitext(params_file)[0] + '.json', 'w') as f:
+        json.dump(provenance, f, indent=1)
+
+
+def load_params(params_file):
+    """
+    Load model parameters and provenance saved by save_params.
+
+    Parameters are memory-mapped, so only the parts used to compute each metric are read from disk. The map is
+    copy-on-write, as some of dipy's (cython) metric functions need a writeable array, but the file is never changed.
+    """
+    with open(os.path.splitext(params_file)[0] + '.json') as f:
+        provenance = json.load(f)
+    return np.load(params_file, mmap_mode='c'), provenance
+
+
+def fit_slabwise(model, img, mask, metrics, memory_limit, n_params, smooth_sigma=None, fit_class=None, n_jobs=1,
+                 out=None, crop=False, dtype=np.float64):
+    """
+    Fit a dipy model to a 4D image one slab of slices at a time, reading each slab from disk on demand.
+
+    Only one slab of the DWI is ever held in memory, so peak memory is controlled by memory_limit (GB)
+    rather than by the size of the acquisition. Each metric is written into a preallocated full-size map.
+
+    model: initialised dipy model (e.g. DiffusionKurtosisModel, FreeWaterTensorModel)
+    img: nibabel image of the DWI (not loaded)
+    mask: boolean 3D array of voxels to fit
+    metrics: dictionary of output name -> function taking the model fit and returning a 3D array
+    n_params: number of model parameters per voxel (used to estimate slab size)
+    smooth_sigma: if given, each slab is smoothed (in float32) with a gaussian of this per-axis std (voxels)
+        before fitting. Slabs are read with extra slices either side so smoothing matches smoothing the whole image.
+    fit_class, n_jobs: fit each slab in parallel, see fit_model
+    out: dictionary of output name -> preallocated array to write into (e.g. from open_params), for outputs
+        that aren't 3D or shouldn't be held in memory. Other outputs are allocated as 3D arrays of zeros.
+    crop: only read and fit slabs within the bounding box of mask (see fit_cropped)
+    dtype: data type to read slabs in if not smoothing
+
+    Returns a dictionary of output name -> 3D array. Voxels in slabs (or outside the bounding box if cropping)
+    without any masked voxels are left as 0.
+    """
+    if crop:
+        fit_box = mask_bbox(mask)
+        read_box = mask_bbox(mask, smoothing_margin(smooth_sigma) if smooth_sigma is not None else 0)
+    else:
+        fit_box = read_box = tuple(slice(0, x) for x in img.shape[:3])
+
+    # gaussian_filter's kernel reaches int(4 * sigma + 0.5) voxels either side (default truncate=4)
+    if smooth_sigma is not None:
+        halo = smoothing_margin(smooth_sigma)[2]
+        dtype = np.float32
+    else:
+        halo = 0
+
+    fit_xy_shape = tuple(x.stop - x.start for x in fit_box[:2])
+    n_slices = slab_thickness(fit_xy_shape + img.shape[2:], memory_limit, n_params, np.dtype(dtype).itemsize)
+    n_z = img.shape[2]
+    # position of the fitted box within the box read from disk
+    inner_xy = tuple(slice(f.start - r.start, f.stop - r.start) for f, r in zip(fit_box[:2], read_box[:2]))
+
+    maps = {name: np.zeros(img.shape[:3]) for name in metrics if name not in (out or {})}
+    maps.update(out or {})
+
+    z_start, z_stop = fit_box[2].start, fit_box[2].stop
+    print("Fitting in slabs of " + str(n_slices) + " slices (" +
+          str(int(np.ceil((z_stop - z_start) / n_slices))) + " slabs)")
+    for z0 in range(z_start, z_stop, n_slices):
+        z1 = min(z0 + n_slices, z_stop)
+        slab_mask = mask[fit_box[0], fit_box[1], z0:z1]
+        if not slab_mask.any():
+            continue
+
+        # read slab (plus halo for smoothing) from disk
+        h0 = max(z0 - halo, 0)
+        h1 = min(z1 + halo, n_z)
+        slab = np.asarray(img.dataobj[read_box[0], read_box[1], h0:h1, :], dtype=dtype)
+        if smooth_sigma is not None:
+            slab = smooth_volumes(slab, smooth_sigma)
+        slab = slab[inner_xy[0], inner_xy[1], z0 - h0:z1 - h0, :]
+
+        slab_fit = fit_model(model, slab, slab_mask, fit_class, n_jobs)
+        for name, metric in metrics.items():
+            maps[name][fit_box[0], fit_box[1], z0:z1] = metric(slab_fit)
+
+    return maps
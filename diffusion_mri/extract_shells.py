@@ -1,8 +1,10 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 import os
-import nibabel as nib
+import sys
 import numpy as np
-from dipy.io.gradients import read_bvals_bvecs
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
+from dwi_utils import detect_shells, split_volumes, load_dwi
 
 
 # Arguments
@@ -13,11 +15,24 @@ Email: tom.veale@ucl.ac.uk
 
 This script extracts volumes with specified shells and writes new DWI volume and associated bvals and bvecs.
 Currently written to work with FSL's .bval and .bvec convention files.
+Only the selected volumes are read from the input DWI and they are saved with the input's data type.
 
 For example, to extract b=0 and b=1000 shells where the bvalues vary +/- 15:
 
     python /path/to/extract_shells.py -i dwi.nii.gz -b dwi.bval -r dwi.bvec -s 0 1000 -t 15
 
+Several shell combinations can be written from one read of the DWI, e.g. b0+b1000, b0+b2000 and all three:
+
+    python /path/to/extract_shells.py -i dwi.nii.gz -b dwi.bval -r dwi.bvec -ss 0,1000 0,2000 0,1000,2000 -t 15
+
+Or shells can be detected automatically (b-values within the threshold of each other are grouped into one shell).
+This writes the lowest shell (b0) with each other shell, and all shells together:
+
+    python /path/to/extract_shells.py -i dwi.nii.gz -b dwi.bval -r dwi.bvec -a -t 15
+
+Shells can also be extracted from python with extract_shells (importing this script with its directory on the python
+path), e.g. extract_shells('dwi.nii.gz', 'dwi.bval', 'dwi.bvec', [[0, 1000], [0, 2000]], threshold=15)
+
 CAUTION!
 Please check your outputs are what you expect! This has not been extensively tested.
 
@@ -37,11 +52,19 @@ parser.add_argument('-b', '--bval',
 parser.add_argument('-r', '--bvec',
                     help='File with bvecs in (.bvec)',
                     required=True)
-parser.add_argument('-s', '--shells',
-                    help='Shells to extract separated by space (e.g. 0 1000)',
-                    nargs='+',
-                    required=True,
-                    type=int)
+shell_args = parser.add_mutually_exclusive_group(required=True)
+shell_args.add_argument('-s', '--shells',
+                        help='Shells to extract separated by space (e.g. 0 1000)',
+                        nargs='+',
+                        type=int)
+shell_args.add_argument('-ss', '--subsets',
+                        help='Several combinations of shells to extract from one read of the DWI. Shells within a '
+                             'combination are separated by commas and combinations by spaces (e.g. 0,1000 0,2000)',
+                        nargs='+')
+shell_args.add_argument('-a', '--auto',
+                        help='Detect shells from the bvals (using --threshold) and extract b0 with each shell '
+                             'and all shells together.',
+                        action='store_true')
 parser.add_argument('-t', '--threshold',
                     help='b-value threshold. Shells will be extracted with +/- this threshold (e.g. 10). Default=0.',
                     required=False,
@@ -50,75 +73,152 @@ parser.add_argument('-t', '--threshold',
 parser.add_argument('-o', '--out_dir',
                     help='Output directory for new files. If not specified, new files will be saved in input DWI location.',
                     required=False)
-
-args = parser.parse_args()
-
-# get bvals and bvecs
-bvals, bvecs = read_bvals_bvecs(args.bval, args.bvec)
-
-# load dwi image
-dwi_img = nib.load(args.dwi)
-data = dwi_img.get_fdata()
-
-# create masks
-masks = np.empty((bvals.shape[0], len(args.shells)))
-
-# for each shell value specified, get indices of shell-values that fall within threshold
-# create a 2D mask structure to store this
-for ishell in range(0, len(args.shells)):
-    masks[:, ishell] = (bvals >= args.shells[ishell]-args.threshold) & (bvals <= args.shells[ishell]+args.threshold)
-
-# check data found for each specified shell
-# To Do: Make check able to tell which shell is missing data
-n_vols = np.sum(masks, axis=0)
-if any(n_vols == 0):
-    raise ValueError('Data not found for at least one shell!')
-
-# add across columns of masks to create a mask that includes all specified shells
-final_mask = np.sum(masks, axis=1)
-
-# check shells werent extracted twice
-if np.sum(final_mask > 1) != 0:
-    print(np.where(final_mask > 1))
-    raise ValueError('Some volumes have been extracted twice! Check your b-values and thresholds for these indices')
-
-# make mask bool
-final_mask = final_mask.astype(bool)
-
-# use mask to select bvals, bvecs and dwi vols for specified shells
-keep_bvals = bvals[final_mask]
-keep_bvecs = bvecs[final_mask, :]
-keep_dwi = data[..., final_mask]
-
-# choose output directory
-if args.out_dir:
-    out_file_dir = args.out_dir
-    if not os.path.exists(out_file_dir):
-        print("Creating new directory: ", out_file_dir)
-        os.makedirs(out_file_dir)
-else:
-    out_file_dir = os.path.dirname(args.dwi)
-
-# create string with shells
-out_file_shells = '_'.join('b' + str(x) for x in args.shells)
-
-# create new filename with specified b-value shells included
-out_dwi_file = os.path.basename(args.dwi).split('.nii.gz')[0] + '_' + str(out_file_shells) + '.nii.gz'
-out_bval_file = os.path.basename(args.bval).split('.bval')[0] + '_' + str(out_file_shells) + '.bval'
-out_bvec_file = os.path.basename(args.bvec).split('.bvec')[0] + '_' + str(out_file_shells) + '.bvec'
-
-# save new dwis
-keep_dwi_img = nib.Nifti1Image(keep_dwi, dwi_img.affine)
-nib.save(keep_dwi_img, os.path.join(out_file_dir, out_dwi_file))
-print('DWI output with', out_file_shells, 'shells saved: ', os.path.join(out_file_dir, out_dwi_file))
-
-# save new bvals
-np.savetxt(os.path.join(out_file_dir, out_bval_file), [keep_bvals.astype(int)], fmt='%i')
-print('bvalues output with', out_file_shells, 'shells saved: ', os.path.join(out_file_dir, out_bval_file))
-
-# save bvecs
-# each row of bvec file is a coordinate: x,y,z so try saving bvec file 1 column at a time
-np.savetxt(os.path.join(out_file_dir, out_bvec_file), (keep_bvecs[:, 0], keep_bvecs[:, 1], keep_bvecs[:, 2]), fmt='%f')
-print('bvector output with', out_file_shells, 'shells saved: ', os.path.join(out_file_dir, out_bvec_file))
-
-
+parser.add_argument('-dc', '--dwi_cache',
+                    help='Directory to cache decompressed DWIs in. A compressed DWI is decompressed once into an '
+                         'uncompressed .nii stored by a hash of its contents, which extract_shells.py, process_dki.py '
+                         'and process_freewater_dti.py then memory map instead of decompressing the DWI again. '
+                         'Default is no cache.',
+                    required=False)
+parser.add_argument('-dcs', '--dwi_cache_size',
+                    help='Maximum size of --dwi_cache in GB. Least recently used DWIs are removed. Default is 20.',
+                    type=float,
+                    default=20,
+                    required=False)
+add_run_log_args(parser)
+
+
+def shell_volumes(bvals, shells, threshold=0):
+    """
+    Boolean mask of the volumes in any of shells (b-values within +/- threshold of each shell).
+    """
+    # create masks
+    masks = np.empty((bvals.shape[0], len(shells)))
+
+    # for each shell value specified, get indices of shell-values that fall within threshold
+    # create a 2D mask structure to store this
+    for ishell in range(0, len(shells)):
+        masks[:, ishell] = (bvals >= shells[ishell]-threshold) & (bvals <= shells[ishell]+threshold)
+
+    # check data found for each specified shell
+    n_vols = np.sum(masks, axis=0)
+    if any(n_vols == 0):
+        missing_shells = [shells[ishell] for ishell in np.flatnonzero(n_vols == 0)]
+        raise ValueError('Data not found for shell(s): ' + ', '.join('b' + str(x) for x in missing_shells) +
+                         '! Check your b-values and threshold.')
+
+    # add across columns of masks to create a mask that includes all specified shells
+    final_mask = np.sum(masks, axis=1)
+
+    # check shells werent extracted twice
+    if np.sum(final_mask > 1) != 0:
+        print(np.where(final_mask > 1))
+        raise ValueError('Some volumes have been extracted twice! Check your b-values and thresholds for these indices')
+
+    # make mask bool
+    return final_mask.astype(bool)
+
+
+def extract_shells(dwi, bval, bvec, shell_subsets=None, threshold=0, out_dir=None, dwi_cache=None,
+                   dwi_cache_size=20):
+    """
+    Write the volumes, bvals and bvecs of each combination of shells to new files, reading the DWI once.
+
+    shell_subsets: list of lists of shells (e.g. [[0, 1000], [0, 2000]]). If None, shells are detected from the
+        bvals and the lowest shell (b0) is extracted with each other shell, and all shells together.
+    out_dir: output directory, default is the directory of the DWI
+    dwi_cache, dwi_cache_size: directory and maximum size (GB) of a cache of decompressed DWIs (see load_dwi)
+
+    Returns a list of (dwi, bval, bvec) output filenames for each combination of shells.
+    """
+    from dipy.io.gradients import read_bvals_bvecs
+
+    # get bvals and bvecs
+    bvals, bvecs = read_bvals_bvecs(bval, bvec)
+
+    # load dwi image header - volumes are read from disk (or the decompressed cached DWI) when saving
+    dwi_img = load_dwi(dwi, dwi_cache, dwi_cache_size)
+
+    # get the combinations of shells to extract
+    if shell_subsets is None:
+        found_shells = detect_shells(bvals, threshold)
+        print('Shells found: ' + ', '.join('b' + str(x) for x in found_shells))
+        if len(found_shells) < 2:
+            raise ValueError('Only one shell found! Check your b-values and threshold.')
+        # check every volume is in exactly one detected shell, so none are lost from the outputs
+        if not shell_volumes(bvals, found_shells, threshold).all():
+            raise ValueError('Some volumes are not within the threshold of a detected shell! '
+                             'Check your b-values and threshold.')
+        # lowest shell is b0, extract it with each other shell and then all shells together
+        shell_subsets = [[found_shells[0], x] for x in found_shells[1:]]
+        if len(found_shells) > 2:
+            shell_subsets.append(found_shells)
+
+    # choose output directory
+    if out_dir:
+        out_file_dir = out_dir
+        if not os.path.exists(out_file_dir):
+            print("Creating new directory: ", out_file_dir)
+            os.makedirs(out_file_dir)
+    else:
+        out_file_dir = os.path.dirname(dwi)
+
+    # shell string, volume mask and output dwi for each combination of shells
+    subset_outputs = []
+    for shells in shell_subsets:
+        final_mask = shell_volumes(bvals, shells, threshold)
+
+        # create string with shells
+        out_file_shells = '_'.join('b' + str(x) for x in shells)
+
+        # create new filename with specified b-value shells included
+        out_dwi_file = os.path.basename(dwi).split('.nii.gz')[0] + '_' + str(out_file_shells) + '.nii.gz'
+        subset_outputs.append((out_file_shells, final_mask, os.path.join(out_file_dir, out_dwi_file)))
+
+    # save new dwis - input dwi is read once for all outputs
+    with stage('split_volumes'):
+        split_volumes(dwi_img, {out_dwi_file: np.flatnonzero(final_mask)
+                                for _, final_mask, out_dwi_file in subset_outputs})
+    for out_file_shells, _, out_dwi_file in subset_outputs:
+        print('DWI output with', out_file_shells, 'shells saved: ', out_dwi_file)
+
+    out_files = []
+    for out_file_shells, final_mask, out_dwi_file in subset_outputs:
+        # use mask to select bvals and bvecs for specified shells
+        keep_bvals = bvals[final_mask]
+        keep_bvecs = bvecs[final_mask, :]
+
+        out_bval_file = os.path.join(out_file_dir,
+                                     os.path.basename(bval).split('.bval')[0] + '_' + str(out_file_shells) + '.bval')
+        out_bvec_file = os.path.join(out_file_dir,
+                                     os.path.basename(bvec).split('.bvec')[0] + '_' + str(out_file_shells) + '.bvec')
+
+        # save new bvals
+        np.savetxt(out_bval_file, [keep_bvals.astype(int)], fmt='%i')
+        print('bvalues output with', out_file_shells, 'shells saved: ', out_bval_file)
+
+        # save bvecs
+        # each row of bvec file is a coordinate: x,y,z so try saving bvec file 1 column at a time
+        np.savetxt(out_bvec_file, (keep_bvecs[:, 0], keep_bvecs[:, 1], keep_bvecs[:, 2]), fmt='%f')
+        print('bvector output with', out_file_shells, 'shells saved: ', out_bvec_file)
+        out_files.append((out_dwi_file, out_bval_file, out_bvec_file))
+
+    return out_files
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    if args.auto:
+        shell_subsets = None
+    elif args.subsets:
+        shell_subsets = [[int(x) for x in subset.split(',')] for subset in args.subsets]
+    else:
+        shell_subsets = [args.shells]
+
+    with record_run('extract_shells', args, args.out_dir or os.path.dirname(args.dwi)):
+        extract_shells(args.dwi, args.bval, args.bvec, shell_subsets, threshold=args.threshold, out_dir=args.out_dir,
+                       dwi_cache=args.dwi_cache, dwi_cache_size=args.dwi_cache_size)
+
+
+if __name__ == '__main__':
+    main()
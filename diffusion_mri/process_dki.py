@@ -1,13 +1,13 @@
 import os
+import sys
 import time
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-import nibabel as nib
 import numpy as np
-from dipy.io.gradients import read_bvals_bvecs
-from dipy.core.gradients import gradient_table
-import dipy.reconst.dki as dki
-from dipy.segment.mask import median_otsu
-from scipy.ndimage import gaussian_filter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
+from dwi_utils import (save_maps, brain_mask, load_gtab, output_prefix, fit_model, fwhm_to_sigma, smooth_volumes,
+                       fit_slabwise, fit_cropped, file_hash, open_params, save_params, load_params, load_dwi,
+                       downsample_image, downsample_mask, preview_affine, select_slices)
 
 # Arguments
 __description__ = '''
@@ -17,8 +17,35 @@ Kurtosis values are clipped between 0-3 for plausible values.
 Option to smooth the data (recommended)
 
 Outputs include: Mean kurtosis, Axial kurtosis and radial kurtosis.
+Other metrics can be chosen with --metrics: mean kurtosis tensor (MKT), kurtosis fractional anisotropy (KFA) and
+the diffusion tensor FA, MD, AD and RD.
+
+With --save_params the fitted model parameters are saved (<dwi>_DKI_params.npy, with how they were fitted in
+<dwi>_DKI_params.json). Rerunning with --params <dwi>_DKI_params.npy then derives any of the metrics without
+fitting the model again.
+
+For a quick quality check (e.g. of the bvec orientation or the mask), --preview 3 fits a copy of the DWI downsampled
+by averaging blocks of 3x3x3 voxels, optionally in only a few slices (--preview_slices), and saves low resolution maps
+named <dwi>_preview3_DKI_<metric>.
+
+The model can also be fitted from python with fit_dki (importing this script with its directory on the python path),
+e.g. to reuse one model for many DWIs with the same gradient table:
+
+    model = dki_model('dwi.bval', 'dwi.bvec')
+    maps = fit_dki('sub-01_dwi.nii.gz', 'dwi.bval', 'dwi.bvec', mask='sub-01_mask.nii.gz', smooth=True, model=model)
 '''
 
+# metrics that can be derived from the DKI fit
+dki_metrics = {'MK': lambda fit: fit.mk(0, 3),
+               'AK': lambda fit: fit.ak(0, 3),
+               'RK': lambda fit: fit.rk(0, 3),
+               'MKT': lambda fit: fit.mkt(0, 3),
+               'KFA': lambda fit: fit.kfa,
+               'FA': lambda fit: fit.fa,
+               'MD': lambda fit: fit.md,
+               'AD': lambda fit: fit.ad,
+               'RD': lambda fit: fit.rd}
+
 # collect inputs
 parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
                         description=__description__)
@@ -37,75 +64,318 @@ parser.add_argument('-m', '--mask',
                          'masking will be done.',
                     required=False)
 parser.add_argument('-s', '--smooth',
-                    help='Smooth the data with a gaussian filter with FWHM of 1.25mm. Default is False.',
+                    help='Smooth each volume in 3D with a gaussian filter with FWHM of 1.25mm (converted to voxels '
+                         'using the image voxel sizes). Smoothing is done in float32. Default is False.',
+                    action='store_true',
+                    required=False)
+parser.add_argument('-ml', '--memory_limit',
+                    help='Approximate memory budget in GB. If specified, the DWI is read and fitted one slab of slices '
+                         'at a time to stay within this budget instead of loading the whole image. Default is to load '
+                         'the whole image.',
+                    type=float,
+                    required=False)
+parser.add_argument('-n', '--n_jobs',
+                    help='Number of processes to fit the model with. Masked voxels are split between processes and '
+                         'results are identical to fitting on one process. Default is 1.',
+                    type=int,
+                    default=1,
+                    required=False)
+parser.add_argument('-mc', '--mask_cache',
+                    help='Directory to cache brain masks in when --mask is not specified. Masks are stored by a hash '
+                         'of the DWI contents and masking parameters, so other scripts and later runs on the same DWI '
+                         'reuse them. Default is no cache.',
+                    required=False)
+parser.add_argument('-mcs', '--mask_cache_size',
+                    help='Maximum size of --mask_cache in GB. Least recently used masks are removed. Default is 1.',
+                    type=float,
+                    default=1,
+                    required=False)
+parser.add_argument('-pr', '--precision',
+                    help='Floating point precision to load, mask and fit the data in. float32 halves the memory of the '
+                         'data (model parameters are still float64). Check the difference it makes to the metrics '
+                         'with validate_precision.py. With --smooth the data is always smoothed and fitted in '
+                         'float32, so this has no effect. Default is float64.',
+                    choices=['float64', 'float32'],
+                    default='float64',
+                    required=False)
+parser.add_argument('-od', '--out_dtype',
+                    help='Data type to save output maps as. Default is --precision.',
+                    choices=['float64', 'float32'],
+                    required=False)
+parser.add_argument('-cl', '--compress_level',
+                    help='gzip compression level (1-9) for output maps. 0 saves uncompressed .nii files. Default is 1.',
+                    type=int,
+                    choices=range(10),
+                    default=1,
+                    required=False)
+parser.add_argument('-sf', '--single_file',
+                    help='Save all output maps as volumes of one 4D file instead of separate files. Default is False.',
+                    action='store_true',
+                    required=False)
+parser.add_argument('-c', '--crop',
+                    help='Only read, smooth and fit the bounding box of the mask instead of the whole field of view. '
+                         'Outputs are still the full size of the DWI. Default is False.',
+                    action='store_true',
+                    required=False)
+parser.add_argument('-me', '--metrics',
+                    help='Metrics to save (space separated). Default is MK AK RK.',
+                    nargs='+',
+                    choices=list(dki_metrics),
+                    default=['MK', 'AK', 'RK'],
+                    required=False)
+parser.add_argument('-sp', '--save_params',
+                    help='Save the fitted model parameters so other metrics can be derived later with --params. '
+                         'Default is False.',
                     action='store_true',
                     required=False)
-args = parser.parse_args()
+parser.add_argument('-p', '--params',
+                    help='Model parameters saved by --save_params. Metrics are derived from these instead of fitting '
+                         'the model.',
+                    required=False)
+parser.add_argument('-pv', '--preview',
+                    help='Quick low resolution fit for quality checks: downsample the DWI by this factor along each '
+                         'spatial axis (averaging blocks of voxels) before fitting, e.g. 3. Maps are saved with '
+                         '_preview<factor> in their names. Default is to fit at full resolution.',
+                    type=int,
+                    required=False)
+parser.add_argument('-ps', '--preview_slices',
+                    help='With --preview, only fit this many evenly spaced axial slices through the mask (other '
+                         'slices are 0). Default is all slices.',
+                    type=int,
+                    required=False)
+parser.add_argument('-o', '--out_dir',
+                    help='Output directory for the maps, --save_params parameters and run log. If not specified, they '
+                         'will be saved in the input DWI location.',
+                    required=False)
+parser.add_argument('-dc', '--dwi_cache',
+                    help='Directory to cache decompressed DWIs in. A compressed DWI is decompressed once into an '
+                         'uncompressed .nii stored by a hash of its contents, which extract_shells.py, process_dki.py '
+                         'and process_freewater_dti.py then memory map instead of decompressing the DWI again. '
+                         'Default is no cache.',
+                    required=False)
+parser.add_argument('-dcs', '--dwi_cache_size',
+                    help='Maximum size of --dwi_cache in GB. Least recently used DWIs are removed. Default is 20.',
+                    type=float,
+                    default=20,
+                    required=False)
+add_run_log_args(parser)
+
+
+def dki_model(bval, bvec):
+    """
+    Initialise a DKI model from .bval and .bvec files. Pass it to fit_dki to reuse it for DWIs with the same
+    gradient table.
+    """
+    import dipy.reconst.dki as dki
+    return dki.DiffusionKurtosisModel(load_gtab(bval, bvec))
+
+
+def fit_dki(dwi, bval, bvec, mask=None, smooth=False, metrics=('MK', 'AK', 'RK'), memory_limit=None, n_jobs=1,
+            mask_cache=None, mask_cache_size=1, crop=False, save_fit_params=False, params=None, model=None,
+            precision='float64', preview=None, preview_slices=None, dwi_cache=None,
+            dwi_cache_size=20, out_dir=None):
+    """
+    Fit the DKI model to a DWI, or derive metrics from previously saved parameters, as the command line does.
+
+    dwi, bval, bvec: filenames of the DWI and its .bval and .bvec files
+    mask: mask filename or array, otherwise dipy brain extraction is used (cached in mask_cache if given)
+    dwi_cache, dwi_cache_size: directory and maximum size (GB) of a cache of decompressed DWIs (see load_dwi)
+    save_fit_params, params: save the fitted parameters next to the DWI (in out_dir if given), or load parameters
+        saved before instead of fitting (see --save_params and --params)
+    precision: 'float64' or 'float32' to load, mask and fit the data in (if smooth, always float32)
+    preview, preview_slices: fit a copy of the DWI downsampled by this factor (with the full resolution mask
+        downsampled to match), in only this many slices if given (see --preview). Maps are the downsampled size, with
+        the affine from preview_affine.
+    model: DKI model from dki_model, to avoid initialising it again. Otherwise it is made from bval and bvec.
+    The other options are as described for the command line.
 
-# get bvals
-print("Loading data...")
-bvals, bvecs = read_bvals_bvecs(args.bval, args.bvec)
-gtab = gradient_table(bvals, bvecs)
+    Returns a dictionary of metric name (e.g. 'MK') -> 3D array.
+    """
+    if preview and (params or save_fit_params):
+        raise ValueError('Model parameters can\'t be saved or loaded in preview mode!')
 
-# load data
-img = nib.load(args.dwi)
-data = img.get_fdata()
-affine = img.affine
+    import dipy.reconst.dki as dki
 
-# if smooth specified, smooth the data
-# often recommended to smooth data before fitting DKI
-if args.smooth:
-    print('Smoothing data with gaussian kernel...')
+    # load data
+    print("Loading data...")
+    with stage('open'):
+        img = load_dwi(dwi, dwi_cache, dwi_cache_size)
+    params_file = output_prefix(dwi, out_dir) + '_DKI_params.npy'
+
+    # initialise DKI model
+    if model is None:
+        print("Initialising DKI model...")
+        with stage('init_model'):
+            model = dki_model(bval, bvec)
+
+    if params:
+        # metrics-only mode - use previously fitted parameters
+        print("Loading DKI model parameters: " + params)
+        dki_params, provenance = load_params(params)
+        if provenance.get('model') != 'DKI' or dki_params.shape[-1] != 27:
+            raise ValueError('Model parameters in ' + params + ' are not DKI parameters (they are ' +
+                             str(provenance.get('model')) + ' parameters with ' + str(dki_params.shape[-1]) +
+                             ' values per voxel)!')
+        print("Parameters fitted on " + provenance['created'] + " from: " + provenance['dwi'])
+        if dki_params.shape[:3] != img.shape[:3]:
+            raise ValueError('Model parameters are not the same shape as the DWI!')
+        dkifit = dki.DiffusionKurtosisFit(model, dki_params)
+        with stage('metrics'):
+            return {m: dki_metrics[m](dkifit) for m in metrics}
+
+    # smoothing kernel
+    # often recommended to smooth data before fitting DKI
     fwhm = 1.25
-    gauss_std = fwhm / np.sqrt(8 * np.log(2))  # converting fwhm to Gaussian std
-    data_input = np.zeros(data.shape)
-    for v in range(data.shape[-1]):
-        data_input[..., v] = gaussian_filter(data[..., v], sigma=gauss_std)
-else:
-    data_input = data
-
-# if mask specified load it
-if args.mask:
-    print("Mask specified, loading mask: " + args.mask)
-    mask_img = nib.load(args.mask)
-    mask_data = mask_img.get_fdata()
-    mask_affine = mask_img.affine
-    # create boolean mask
-    mask = mask_data != 0
-
-# if mask not specified, use basic brain extraction used in dipy
-else:
-    print("Mask not specified, running dipy brain extraction...")
-    maskdata, mask = median_otsu(data_input, vol_idx=[0, 1], median_radius=4, numpass=2, autocrop=False, dilate=1)
-
-# initialise DKI model
-print("Initialising DKI model...")
-dkimodel = dki.DiffusionKurtosisModel(gtab)
-
-# fit the DKI model
-print("Fitting DKI model...")
-t0 = time.time()
-dkifit = dkimodel.fit(data_input, mask=mask)
-t1 = time.time()
-print("Fitting took: " + str((t1-t0)/60) + " minutes")
-
-# extract mean kurtosis, axial kurtosis and radial kurtosis from the dkimodel
-MK = dkifit.mk(0,3)
-AK = dkifit.ak(0,3)
-RK = dkifit.rk(0,3)
-
-# save outputs
-MK_nifti = nib.Nifti1Image(MK, affine)
-MK_filename = os.path.join(os.path.dirname(args.dwi), os.path.basename(args.dwi.split('.')[0])) + '_DKI_MK.nii.gz'
-nib.save(MK_nifti, MK_filename)
-print("MK saved to: " + MK_filename)
-
-AK_nifti = nib.Nifti1Image(AK, affine)
-AK_filename = os.path.join(os.path.dirname(args.dwi), os.path.basename(args.dwi.split('.')[0])) + '_DKI_AK.nii.gz'
-nib.save(AK_nifti, AK_filename)
-print("AK saved to: " + AK_filename)
-
-RK_nifti = nib.Nifti1Image(RK, affine)
-RK_filename = os.path.join(os.path.dirname(args.dwi), os.path.basename(args.dwi.split('.')[0])) + '_DKI_RK.nii.gz'
-nib.save(RK_nifti, RK_filename)
-print("RK saved to: " + RK_filename)
+    gauss_std = fwhm_to_sigma(fwhm, img.header.get_zooms())  # converting fwhm in mm to Gaussian std in voxels
+
+    if preview:
+        # quick low resolution fit - the mask is made at full resolution, as for a full fit, then downsampled with
+        # the data, which is used in place of the DWI from here on
+        with stage('mask'):
+            mask = downsample_mask(brain_mask(img, dwi, mask,
+                                              smooth_fwhm=fwhm if smooth else None,
+                                              mask_cache=mask_cache,
+                                              mask_cache_size=mask_cache_size,
+                                              dtype=precision), preview)
+        print("Preview mode, downsampling data by a factor of " + str(preview) + "...")
+        with stage('downsample'):
+            img = downsample_image(img, preview, precision)
+        gauss_std = fwhm_to_sigma(fwhm, img.header.get_zooms())  # in downsampled voxels
+
+    if memory_limit:
+        # streaming mode - data is read one slab at a time during fitting
+        print("Memory limit of " + str(memory_limit) + "GB specified, data will be fitted slab-wise")
+        data_input = None
+    elif crop:
+        # data is read within the mask bounding box when fitting
+        data_input = None
+    else:
+        # if smooth specified, smooth the data in place in float32
+        if smooth:
+            with stage('load'):
+                data = img.get_fdata(dtype=np.float32)
+            print('Smoothing data with gaussian kernel...')
+            with stage('smooth'):
+                data_input = smooth_volumes(data, gauss_std)
+        else:
+            with stage('load'):
+                data = img.get_fdata(dtype=precision)
+            data_input = data
+
+    # load mask, or use basic brain extraction used in dipy if not specified
+    mask_source = os.path.abspath(mask) if isinstance(mask, str) else 'median_otsu' if mask is None else 'array'
+    with stage('mask'):
+        mask = brain_mask(img, dwi, mask, data_input,
+                          smooth_fwhm=fwhm if smooth else None,
+                          mask_cache=mask_cache,
+                          mask_cache_size=mask_cache_size,
+                          dtype=precision)
+        if preview and preview_slices:
+            mask = select_slices(mask, preview_slices)
+
+    # fit the DKI model
+    # in streaming and crop modes reading (and smoothing) the data is part of fitting
+    print("Fitting DKI model...")
+    t0 = time.time()
+    with stage('fit'):
+        if memory_limit:
+            # extract metrics (and parameters) from each slab's fit
+            slab_metrics = {m: dki_metrics[m] for m in metrics}
+            params_out = {}
+            if save_fit_params:
+                slab_metrics['params'] = lambda fit: fit.model_params
+                params_out['params'] = open_params(params_file, img.shape[:3] + (27,))
+            dki_maps = fit_slabwise(model, img, mask,
+                                    metrics=slab_metrics,
+                                    memory_limit=memory_limit,
+                                    n_params=27,
+                                    smooth_sigma=gauss_std if smooth else None,
+                                    fit_class=dki.DiffusionKurtosisFit,
+                                    n_jobs=n_jobs,
+                                    out=params_out,
+                                    crop=crop,
+                                    dtype=precision)
+            dki_params = dki_maps.pop('params', None)
+        elif crop:
+            dkifit = fit_cropped(model, img, mask, dki.DiffusionKurtosisFit,
+                                 smooth_sigma=gauss_std if smooth else None,
+                                 n_jobs=n_jobs,
+                                 dtype=precision)
+            dki_params = dkifit.model_params
+        else:
+            dkifit = fit_model(model, data_input, mask, dki.DiffusionKurtosisFit, n_jobs)
+            dki_params = dkifit.model_params
+    t1 = time.time()
+    print("Fitting took: " + str((t1-t0)/60) + " minutes")
+
+    # extract metrics from the dkimodel
+    if not memory_limit:
+        with stage('metrics'):
+            dki_maps = {m: dki_metrics[m](dkifit) for m in metrics}
+
+    # save model parameters and how they were fitted
+    if save_fit_params:
+        with stage('save_params'):
+            save_params(params_file, dki_params,
+                        model='DKI',
+                        dwi=os.path.abspath(dwi),
+                        dwi_sha256=file_hash(dwi),
+                        bval=os.path.abspath(bval),
+                        bvec=os.path.abspath(bvec),
+                        mask=mask_source,
+                        smooth_fwhm=fwhm if smooth else None,
+                        precision=precision)
+        print("DKI model parameters saved to: " + params_file)
+
+    return dki_maps
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.preview and (args.save_params or args.params):
+        parser.error('--preview can\'t be used with --save_params or --params')
+    if args.preview_slices and not args.preview:
+        parser.error('--preview_slices needs --preview')
+
+    import nibabel as nib
+
+    # preview maps are low resolution, so are named and saved with the downsampled affine
+    affine = nib.load(args.dwi).affine
+    if args.out_dir and not os.path.exists(args.out_dir):
+        print("Creating new directory: ", args.out_dir)
+        os.makedirs(args.out_dir)
+    out_prefix = output_prefix(args.dwi, args.out_dir)
+    if args.preview:
+        affine = preview_affine(affine, args.preview)
+        out_prefix += '_preview' + str(args.preview)
+
+    with record_run('process_dki', args, args.out_dir or os.path.dirname(args.dwi)):
+        dki_maps = fit_dki(args.dwi, args.bval, args.bvec,
+                           mask=args.mask,
+                           smooth=args.smooth,
+                           metrics=args.metrics,
+                           memory_limit=args.memory_limit,
+                           n_jobs=args.n_jobs,
+                           mask_cache=args.mask_cache,
+                           mask_cache_size=args.mask_cache_size,
+                           crop=args.crop,
+                           save_fit_params=args.save_params,
+                           params=args.params,
+                           precision=args.precision,
+                           preview=args.preview,
+                           preview_slices=args.preview_slices,
+                           dwi_cache=args.dwi_cache,
+                           dwi_cache_size=args.dwi_cache_size,
+                           out_dir=args.out_dir)
+
+        # save outputs
+        with stage('save'):
+            save_maps({'DKI_' + m: dki_maps[m] for m in args.metrics},
+                      affine, out_prefix,
+                      dtype=args.out_dtype or args.precision,
+                      compress_level=args.compress_level,
+                      single_file='DKI' if args.single_file else None)
+
+
+if __name__ == '__main__':
+    main()
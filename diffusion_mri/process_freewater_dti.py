@@ -1,11 +1,12 @@
 import os
+import sys
 import time
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-import nibabel as nib
-from dipy.io.gradients import read_bvals_bvecs
-from dipy.core.gradients import gradient_table
-import dipy.reconst.fwdti as fwdti
-from dipy.segment.mask import median_otsu
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
+from dwi_utils import (save_maps, brain_mask, load_gtab, output_prefix, fit_model, fit_slabwise, fit_cropped,
+                       file_hash, open_params, save_params, load_params, load_dwi, downsample_image, downsample_mask,
+                       preview_affine, select_slices)
 
 # Arguments
 __description__ = '''
@@ -31,8 +32,29 @@ Henriques, R.N., Rokem, A., Garyfallidis, E., St-Jean, S., Peterson E.T., Correi
     [Re] Optimization of a free water elimination two-compartment model for diffusion tensor imaging.
     ReScience volume 3, issue 1, article number 2
 
+Other free water corrected metrics can be chosen with --metrics: axial diffusivity (AD) and radial diffusivity (RD).
+With --save_params the fitted model parameters are saved (<dwi>_fwDTI_params.npy, with how they were fitted in
+<dwi>_fwDTI_params.json). Rerunning with --params <dwi>_fwDTI_params.npy then derives any of the metrics without
+fitting the model again.
+
+For a quick quality check (e.g. of the bvec orientation or the mask), --preview 3 fits a copy of the DWI downsampled
+by averaging blocks of 3x3x3 voxels, optionally in only a few slices (--preview_slices), and saves low resolution maps
+named <dwi>_preview3_fwDTI_<metric>.
+
+The model can also be fitted from python with fit_fwdti (importing this script with its directory on the python
+path), e.g. to reuse one model for many DWIs with the same gradient table:
+
+    model = fwdti_model('dwi.bval', 'dwi.bvec')
+    maps = fit_fwdti('sub-01_dwi.nii.gz', 'dwi.bval', 'dwi.bvec', mask='sub-01_mask.nii.gz', model=model)
 '''
 
+# metrics that can be derived from the fwDTI fit
+fwdti_metrics = {'FA': lambda fit: fit.fa,
+                 'MD': lambda fit: fit.md,
+                 'FW': lambda fit: fit.f,
+                 'AD': lambda fit: fit.ad,
+                 'RD': lambda fit: fit.rd}
+
 # collect inputs
 parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
                         description=__description__)
@@ -50,60 +72,290 @@ parser.add_argument('-m', '--mask',
                     help='File with mask to fit model within. If not specified, simple dipy brain extraction'
                          'masking will be done.',
                     required=False)
-args = parser.parse_args()
-
-# get bvals
-print("Loading data...")
-bvals, bvecs = read_bvals_bvecs(args.bval, args.bvec)
-gtab = gradient_table(bvals, bvecs)
-
-# load data
-img = nib.load(args.dwi)
-data = img.get_fdata()
-affine = img.affine
-
-# if mask specified load it
-if args.mask:
-    print("Mask specified, loading mask: " + args.mask)
-    mask_img = nib.load(args.mask)
-    mask_data = mask_img.get_fdata()
-    mask_affine = mask_img.affine
-    # create boolean mask
-    mask = mask_data != 0
-
-# if mask not specified, use basic brain extraction used in dipy
-else:
-    print("Mask not specified, running dipy brain extraction...")
-    maskdata, mask = median_otsu(data, vol_idx=[0, 1], median_radius=4, numpass=2, autocrop=False, dilate=1)
-
-# initialise free water DTI model
-print("Initialising fwDTI model...")
-fwdtimodel = fwdti.FreeWaterTensorModel(gtab)
-
-# fit the fwDTI model
-print("Fitting fwDTI model...")
-t0 = time.time()
-fwdtifit = fwdtimodel.fit(data, mask=mask)
-t1 = time.time()
-print("Fitting took: " + str((t1-t0)/60) + " minutes")
-
-# extract fwFA, fwMD and FW from the fwDTI model
-FA = fwdtifit.fa
-MD = fwdtifit.md
-FW = fwdtifit.f
-
-# save outputs
-FA_nifti = nib.Nifti1Image(FA, affine)
-FA_filename = os.path.join(os.path.dirname(args.dwi), os.path.basename(args.dwi.split('.')[0])) + '_fwDTI_FA.nii.gz'
-nib.save(FA_nifti, FA_filename)
-print("fwFA saved to: " + FA_filename)
-
-MD_nifti = nib.Nifti1Image(MD, affine)
-MD_filename = os.path.join(os.path.dirname(args.dwi), os.path.basename(args.dwi.split('.')[0])) + '_fwDTI_MD.nii.gz'
-nib.save(MD_nifti, MD_filename)
-print("fwMD saved to: " + MD_filename)
-
-FW_nifti = nib.Nifti1Image(FW, affine)
-FW_filename = os.path.join(os.path.dirname(args.dwi), os.path.basename(args.dwi.split('.')[0])) + '_fwDTI_FW.nii.gz'
-nib.save(FW_nifti, FW_filename)
-print("FW saved to: " + FW_filename)
+parser.add_argument('-ml', '--memory_limit',
+                    help='Approximate memory budget in GB. If specified, the DWI is read and fitted one slab of slices '
+                         'at a time to stay within this budget instead of loading the whole image. Default is to load '
+                         'the whole image.',
+                    type=float,
+                    required=False)
+parser.add_argument('-n', '--n_jobs',
+                    help='Number of processes to fit the model with. Masked voxels are split between processes and '
+                         'results are identical to fitting on one process. Default is 1.',
+                    type=int,
+                    default=1,
+                    required=False)
+parser.add_argument('-mc', '--mask_cache',
+                    help='Directory to cache brain masks in when --mask is not specified. Masks are stored by a hash '
+                         'of the DWI contents and masking parameters, so other scripts and later runs on the same DWI '
+                         'reuse them. Default is no cache.',
+                    required=False)
+parser.add_argument('-mcs', '--mask_cache_size',
+                    help='Maximum size of --mask_cache in GB. Least recently used masks are removed. Default is 1.',
+                    type=float,
+                    default=1,
+                    required=False)
+parser.add_argument('-pr', '--precision',
+                    help='Floating point precision to load, mask and fit the data in. float32 halves the memory of the '
+                         'data (model parameters are still float64). Check the difference it makes to the metrics '
+                         'with validate_precision.py. Default is float64.',
+                    choices=['float64', 'float32'],
+                    default='float64',
+                    required=False)
+parser.add_argument('-od', '--out_dtype',
+                    help='Data type to save output maps as. Default is --precision.',
+                    choices=['float64', 'float32'],
+                    required=False)
+parser.add_argument('-cl', '--compress_level',
+                    help='gzip compression level (1-9) for output maps. 0 saves uncompressed .nii files. Default is 1.',
+                    type=int,
+                    choices=range(10),
+                    default=1,
+                    required=False)
+parser.add_argument('-sf', '--single_file',
+                    help='Save all output maps as volumes of one 4D file instead of separate files. Default is False.',
+                    action='store_true',
+                    required=False)
+parser.add_argument('-c', '--crop',
+                    help='Only read, smooth and fit the bounding box of the mask instead of the whole field of view. '
+                         'Outputs are still the full size of the DWI. Default is False.',
+                    action='store_true',
+                    required=False)
+parser.add_argument('-me', '--metrics',
+                    help='Metrics to save (space separated). Default is FA MD FW.',
+                    nargs='+',
+                    choices=list(fwdti_metrics),
+                    default=['FA', 'MD', 'FW'],
+                    required=False)
+parser.add_argument('-sp', '--save_params',
+                    help='Save the fitted model parameters so other metrics can be derived later with --params. '
+                         'Default is False.',
+                    action='store_true',
+                    required=False)
+parser.add_argument('-p', '--params',
+                    help='Model parameters saved by --save_params. Metrics are derived from these instead of fitting '
+                         'the model.',
+                    required=False)
+parser.add_argument('-pv', '--preview',
+                    help='Quick low resolution fit for quality checks: downsample the DWI by this factor along each '
+                         'spatial axis (averaging blocks of voxels) before fitting, e.g. 3. Maps are saved with '
+                         '_preview<factor> in their names. Default is to fit at full resolution.',
+                    type=int,
+                    required=False)
+parser.add_argument('-ps', '--preview_slices',
+                    help='With --preview, only fit this many evenly spaced axial slices through the mask (other '
+                         'slices are 0). Default is all slices.',
+                    type=int,
+                    required=False)
+parser.add_argument('-o', '--out_dir',
+                    help='Output directory for the maps, --save_params parameters and run log. If not specified, they '
+                         'will be saved in the input DWI location.',
+                    required=False)
+parser.add_argument('-dc', '--dwi_cache',
+                    help='Directory to cache decompressed DWIs in. A compressed DWI is decompressed once into an '
+                         'uncompressed .nii stored by a hash of its contents, which extract_shells.py, process_dki.py '
+                         'and process_freewater_dti.py then memory map instead of decompressing the DWI again. '
+                         'Default is no cache.',
+                    required=False)
+parser.add_argument('-dcs', '--dwi_cache_size',
+                    help='Maximum size of --dwi_cache in GB. Least recently used DWIs are removed. Default is 20.',
+                    type=float,
+                    default=20,
+                    required=False)
+add_run_log_args(parser)
+
+
+def fwdti_model(bval, bvec):
+    """
+    Initialise a fwDTI model from .bval and .bvec files. Pass it to fit_fwdti to reuse it for DWIs with the same
+    gradient table.
+    """
+    import dipy.reconst.fwdti as fwdti
+    return fwdti.FreeWaterTensorModel(load_gtab(bval, bvec))
+
+
+def fit_fwdti(dwi, bval, bvec, mask=None, metrics=('FA', 'MD', 'FW'), memory_limit=None, n_jobs=1, mask_cache=None,
+              mask_cache_size=1, crop=False, save_fit_params=False, params=None, model=None,
+              precision='float64', preview=None, preview_slices=None, dwi_cache=None,
+              dwi_cache_size=20, out_dir=None):
+    """
+    Fit the fwDTI model to a DWI, or derive metrics from previously saved parameters, as the command line does.
+
+    dwi, bval, bvec: filenames of the DWI and its .bval and .bvec files
+    mask: mask filename or array, otherwise dipy brain extraction is used (cached in mask_cache if given)
+    dwi_cache, dwi_cache_size: directory and maximum size (GB) of a cache of decompressed DWIs (see load_dwi)
+    save_fit_params, params: save the fitted parameters next to the DWI (in out_dir if given), or load parameters
+        saved before instead of fitting (see --save_params and --params)
+    precision: 'float64' or 'float32' to load, mask and fit the data in
+    preview, preview_slices: fit a copy of the DWI downsampled by this factor (with the full resolution mask
+        downsampled to match), in only this many slices if given (see --preview). Maps are the downsampled size, with
+        the affine from preview_affine.
+    model: fwDTI model from fwdti_model, to avoid initialising it again. Otherwise it is made from bval and bvec.
+    The other options are as described for the command line.
+
+    Returns a dictionary of metric name (e.g. 'FA') -> 3D array.
+    """
+    if preview and (params or save_fit_params):
+        raise ValueError('Model parameters can\'t be saved or loaded in preview mode!')
+
+    import dipy.reconst.fwdti as fwdti
+
+    # load data
+    print("Loading data...")
+    with stage('open'):
+        img = load_dwi(dwi, dwi_cache, dwi_cache_size)
+    params_file = output_prefix(dwi, out_dir) + '_fwDTI_params.npy'
+
+    # initialise free water DTI model
+    if model is None:
+        print("Initialising fwDTI model...")
+        with stage('init_model'):
+            model = fwdti_model(bval, bvec)
+
+    if params:
+        # metrics-only mode - use previously fitted parameters
+        print("Loading fwDTI model parameters: " + params)
+        fwdti_params, provenance = load_params(params)
+        if provenance.get('model') != 'fwDTI' or fwdti_params.shape[-1] != 13:
+            raise ValueError('Model parameters in ' + params + ' are not fwDTI parameters (they are ' +
+                             str(provenance.get('model')) + ' parameters with ' + str(fwdti_params.shape[-1]) +
+                             ' values per voxel)!')
+        print("Parameters fitted on " + provenance['created'] + " from: " + provenance['dwi'])
+        if fwdti_params.shape[:3] != img.shape[:3]:
+            raise ValueError('Model parameters are not the same shape as the DWI!')
+        fwdtifit = fwdti.FreeWaterTensorFit(model, fwdti_params)
+        with stage('metrics'):
+            return {m: fwdti_metrics[m](fwdtifit) for m in metrics}
+
+    if preview:
+        # quick low resolution fit - the mask is made at full resolution, as for a full fit, then downsampled with
+        # the data, which is used in place of the DWI from here on
+        with stage('mask'):
+            mask = downsample_mask(brain_mask(img, dwi, mask,
+                                              mask_cache=mask_cache,
+                                              mask_cache_size=mask_cache_size,
+                                              dtype=precision), preview)
+        print("Preview mode, downsampling data by a factor of " + str(preview) + "...")
+        with stage('downsample'):
+            img = downsample_image(img, preview, precision)
+
+    if memory_limit:
+        # streaming mode - data is read one slab at a time during fitting
+        print("Memory limit of " + str(memory_limit) + "GB specified, data will be fitted slab-wise")
+        data = None
+    elif crop:
+        # data is read within the mask bounding box when fitting
+        data = None
+    else:
+        with stage('load'):
+            data = img.get_fdata(dtype=precision)
+
+    # load mask, or use basic brain extraction used in dipy if not specified
+    mask_source = os.path.abspath(mask) if isinstance(mask, str) else 'median_otsu' if mask is None else 'array'
+    with stage('mask'):
+        mask = brain_mask(img, dwi, mask, data,
+                          mask_cache=mask_cache,
+                          mask_cache_size=mask_cache_size,
+                          dtype=precision)
+        if preview and preview_slices:
+            mask = select_slices(mask, preview_slices)
+
+    # fit the fwDTI model
+    # in streaming and crop modes reading the data is part of fitting
+    print("Fitting fwDTI model...")
+    t0 = time.time()
+    with stage('fit'):
+        if memory_limit:
+            # extract metrics (and parameters) from each slab's fit
+            slab_metrics = {m: fwdti_metrics[m] for m in metrics}
+            params_out = {}
+            if save_fit_params:
+                slab_metrics['params'] = lambda fit: fit.model_params
+                params_out['params'] = open_params(params_file, img.shape[:3] + (13,))
+            fwdti_maps = fit_slabwise(model, img, mask,
+                                      metrics=slab_metrics,
+                                      memory_limit=memory_limit,
+                                      n_params=13,
+                                      fit_class=fwdti.FreeWaterTensorFit,
+                                      n_jobs=n_jobs,
+                                      out=params_out,
+                                      crop=crop,
+                                      dtype=precision)
+            fwdti_params = fwdti_maps.pop('params', None)
+        elif crop:
+            fwdtifit = fit_cropped(model, img, mask, fwdti.FreeWaterTensorFit, n_jobs=n_jobs, dtype=precision)
+            fwdti_params = fwdtifit.model_params
+        else:
+            fwdtifit = fit_model(model, data, mask, fwdti.FreeWaterTensorFit, n_jobs)
+            fwdti_params = fwdtifit.model_params
+    t1 = time.time()
+    print("Fitting took: " + str((t1-t0)/60) + " minutes")
+
+    # extract metrics from the fwDTI model
+    if not memory_limit:
+        with stage('metrics'):
+            fwdti_maps = {m: fwdti_metrics[m](fwdtifit) for m in metrics}
+
+    # save model parameters and how they were fitted
+    if save_fit_params:
+        with stage('save_params'):
+            save_params(params_file, fwdti_params,
+                        model='fwDTI',
+                        dwi=os.path.abspath(dwi),
+                        dwi_sha256=file_hash(dwi),
+                        bval=os.path.abspath(bval),
+                        bvec=os.path.abspath(bvec),
+                        mask=mask_source,
+                        precision=precision)
+        print("fwDTI model parameters saved to: " + params_file)
+
+    return fwdti_maps
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.preview and (args.save_params or args.params):
+        parser.error('--preview can\'t be used with --save_params or --params')
+    if args.preview_slices and not args.preview:
+        parser.error('--preview_slices needs --preview')
+
+    import nibabel as nib
+
+    # preview maps are low resolution, so are named and saved with the downsampled affine
+    affine = nib.load(args.dwi).affine
+    if args.out_dir and not os.path.exists(args.out_dir):
+        print("Creating new directory: ", args.out_dir)
+        os.makedirs(args.out_dir)
+    out_prefix = output_prefix(args.dwi, args.out_dir)
+    if args.preview:
+        affine = preview_affine(affine, args.preview)
+        out_prefix += '_preview' + str(args.preview)
+
+    with record_run('process_freewater_dti', args, args.out_dir or os.path.dirname(args.dwi)):
+        fwdti_maps = fit_fwdti(args.dwi, args.bval, args.bvec,
+                               mask=args.mask,
+                               metrics=args.metrics,
+                               memory_limit=args.memory_limit,
+                               n_jobs=args.n_jobs,
+                               mask_cache=args.mask_cache,
+                               mask_cache_size=args.mask_cache_size,
+                               crop=args.crop,
+                               save_fit_params=args.save_params,
+                               params=args.params,
+                               precision=args.precision,
+                               preview=args.preview,
+                               preview_slices=args.preview_slices,
+                               dwi_cache=args.dwi_cache,
+                               dwi_cache_size=args.dwi_cache_size,
+                               out_dir=args.out_dir)
+
+        # save outputs
+        with stage('save'):
+            save_maps({'fwDTI_' + m: fwdti_maps[m] for m in args.metrics},
+                      affine, out_prefix,
+                      dtype=args.out_dtype or args.precision,
+                      compress_level=args.compress_level,
+                      single_file='fwDTI' if args.single_file else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+import os
+import sys
+import glob
+import json
+import importlib.util
+import shlex
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from dwi_utils import file_hash, output_prefix
+
+__description__ = '''
+Run the diffusion scripts over every subject in a BIDS directory.
+
+DWIs are found as sub-*/[ses-*/]dwi/*_dwi.nii.gz with matching .bval and .bvec files. For each DWI these stages are
+run in order (choose with --stages):
+
+    shells   extract_shells.py      --fwdti_shells / --dki_shells subsets
+    fwdti    process_freewater_dti.py on the DWI (or its --fwdti_shells subset)
+    dki      process_dki.py on the DWI (or its --dki_shells subset)
+    roi      regions_of_interest/extract_roi_metrics.py of the fwDTI and DKI maps within --labels
+    collate  csv/concatenate_csvs.py of every subject's roi_metrics.csv (once, after all subjects)
+
+Every output (and run log and stamp file) is saved in derivatives/neuroimaging_helper of --bids_dir, in the same
+sub-*/[ses-*/]dwi directories as the DWIs, so the raw BIDS tree is never written to.
+
+Subjects are run in parallel worker processes. Each worker imports the scripts and calls their main functions, so
+dipy etc. are imported once per worker rather than once per script. Subjects are started while the estimated memory
+of running subjects stays within --memory_budget.
+
+A stage is skipped if its outputs exist and a stamp file saved when it last finished (.<stage>_<output>.json next
+to its outputs) has the same script arguments and input file hashes. Rerunning after a crash carries on from the
+stages that didn't finish, and a stage is only rerun if its inputs have actually changed.
+
+For example:
+
+    python /path/to/run_cohort.py -bd /data/bids --stages shells fwdti dki --fwdti_shells 0,1000
+        --dki_shells 0,1000,2000 --memory_budget 64 --fit_args "--crop --mask_cache /data/mask_cache"
+'''
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+stage_scripts = {'shells': os.path.join(script_dir, 'extract_shells.py'),
+                 'fwdti': os.path.join(script_dir, 'process_freewater_dti.py'),
+                 'dki': os.path.join(script_dir, 'process_dki.py'),
+                 'roi': os.path.join(script_dir, '..', 'regions_of_interest', 'extract_roi_metrics.py'),
+                 'collate': os.path.join(script_dir, '..', 'csv', 'concatenate_csvs.py')}
+
+
+def find_dwis(bids_dir):
+    """
+    Find (dwi, bval, bvec) files for every subject (and session) in a BIDS directory.
+    """
+    dwis = []
+    for dwi in sorted(glob.glob(os.path.join(bids_dir, 'sub-*', 'dwi', '*_dwi.nii.gz')) +
+                      glob.glob(os.path.join(bids_dir, 'sub-*', 'ses-*', 'dwi', '*_dwi.nii.gz'))):
+        bval = dwi.replace('.nii.gz', '.bval')
+        bvec = dwi.replace('.nii.gz', '.bvec')
+        if os.path.exists(bval) and os.path.exists(bvec):
+            dwis.append((dwi, bval, bvec))
+        else:
+            print('Skipping DWI without .bval and .bvec: ' + dwi)
+    return dwis
+
+
+def derivatives_dir(bids_dir):
+    # directory of every output of the stages
+    return os.path.join(bids_dir, 'derivatives', 'neuroimaging_helper')
+
+
+def subject_stages(dwi, bval, bvec, args):
+    """
+    List the stages to run for one DWI. Each stage is a dictionary of name, script, args, inputs and outputs.
+    """
+    stages = []
+    fit_dwis = {'fwdti': (dwi, bval, bvec), 'dki': (dwi, bval, bvec)}
+    cache_args = ['--dwi_cache', args.dwi_cache, '--dwi_cache_size', str(args.dwi_cache_size)] if args.dwi_cache else []
+    entities = os.path.basename(dwi).split('_dwi.nii.gz')[0]
+    out_dir = os.path.join(derivatives_dir(args.bids_dir), os.path.relpath(os.path.dirname(dwi), args.bids_dir))
+
+    # extract shells for each model in one pass over the DWI
+    shell_subsets = {model: shells for model, shells in [('fwdti', args.fwdti_shells), ('dki', args.dki_shells)]
+                     if shells}
+    if 'shells' in args.stages and shell_subsets:
+        outputs = []
+        for model, shells in shell_subsets.items():
+            out_file_shells = '_'.join('b' + x for x in shells.split(','))
+            fit_dwis[model] = tuple(
+                os.path.join(out_dir, os.path.basename(in_file).split(ext)[0] + '_' + out_file_shells + ext)
+                for in_file, ext in [(dwi, '.nii.gz'), (bval, '.bval'), (bvec, '.bvec')])
+            outputs.extend(fit_dwis[model])
+        stages.append({'name': 'shells',
+                       'script': stage_scripts['shells'],
+                       'args': ['-i', dwi, '-b', bval, '-r', bvec, '-t', str(args.threshold), '-o', out_dir,
+                                '-ss'] + sorted(set(shell_subsets.values())) + cache_args,
+                       'inputs': [dwi, bval, bvec],
+                       'outputs': sorted(set(outputs))})
+
+    # fit models
+    maps = []
+    map_names = []
+    for model, model_name in [('fwdti', 'fwDTI'), ('dki', 'DKI')]:
+        if model not in args.stages:
+            continue
+        model_dwi, model_bval, model_bvec = fit_dwis[model]
+        model_args = (['-i', model_dwi, '-bval', model_bval, '-bvec', model_bvec, '-o', out_dir] +
+                      shlex.split(args.fit_args) + cache_args)
+        if model == 'dki' and args.smooth:
+            model_args.append('--smooth')
+
+        # output maps as named by the fit arguments, parsed as the script will
+        fit_options = load_script(stage_scripts[model]).parser.parse_args(model_args)
+        out_prefix = output_prefix(model_dwi, fit_options.out_dir)
+        if fit_options.preview:
+            out_prefix += '_preview' + str(fit_options.preview)
+        ext = '.nii' if fit_options.compress_level == 0 else '.nii.gz'
+        if fit_options.single_file:
+            outputs = [out_prefix + '_' + model_name + ext]
+        else:
+            outputs = [out_prefix + '_' + model_name + '_' + x + ext for x in fit_options.metrics]
+        if 'roi' in args.stages and args.labels and (fit_options.single_file or fit_options.preview):
+            raise ValueError('The roi stage needs full resolution maps in separate files, so --fit_args can\'t '
+                             'include --single_file or --preview')
+
+        # files named in the fit arguments are inputs too, so the stage reruns when they change
+        fit_inputs = [x for x in [fit_options.mask, fit_options.params] if x]
+        stages.append({'name': model,
+                       'script': stage_scripts[model],
+                       'args': model_args,
+                       'inputs': [model_dwi, model_bval, model_bvec] + fit_inputs,
+                       'outputs': outputs})
+        maps.extend(outputs)
+        map_names.extend(model_name + '_' + x for x in fit_options.metrics)
+
+    # summarise maps within labels
+    if 'roi' in args.stages and args.labels and maps:
+        sub = entities.split('_')[0]
+        ses = [x for x in entities.split('_') if x.startswith('ses-')]
+        labels = os.path.join(args.bids_dir, args.labels.format(sub=sub, ses=ses[0] if ses else '',
+                                                                entities=entities))
+        roi_output = os.path.join(out_dir, entities + '_roi_metrics.csv')
+        stages.append({'name': 'roi',
+                       'script': stage_scripts['roi'],
+                       'args': ['-i', labels, '-m'] + maps + ['-n'] + map_names + ['-o', roi_output],
+                       'inputs': [labels] + maps,
+                       'outputs': [roi_output]})
+    return stages
+
+
+def stage_stamp(stage):
+    # stamp file saved next to a stage's outputs when it finishes
+    return os.path.join(os.path.dirname(stage['outputs'][0]),
+                        '.' + stage['name'] + '_' + os.path.basename(stage['outputs'][0]) + '.json')
+
+
+def input_info(inputs, previous_info):
+    # size, modification time and hash of each input, only rehashing files whose size or modification time changed
+    info = {}
+    for input_file in inputs:
+        file_stat = os.stat(input_file)
+        previous = previous_info.get(input_file, {})
+        if previous.get('size') == file_stat.st_size and previous.get('mtime') == file_stat.st_mtime:
+            sha256 = previous['sha256']
+        else:
+            sha256 = file_hash(input_file)
+        info[input_file] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'sha256': sha256}
+    return info
+
+
+def stage_up_to_date(stage):
+    """
+    A stage is up to date if its outputs exist and its stamp has the same arguments and input hashes.
+
+    Returns (up to date, current input info).
+    """
+    stamp_file = stage_stamp(stage)
+    if not os.path.exists(stamp_file):
+        return False, input_info(stage['inputs'], {})
+    with open(stamp_file) as f:
+        stamp = json.load(f)
+    current_info = input_info(stage['inputs'], stamp['inputs'])
+    up_to_date = (all(os.path.exists(x) for x in stage['outputs']) and stamp['args'] == stage['args'] and
+                  {k: v['sha256'] for k, v in current_info.items()} ==
+                  {k: v['sha256'] for k, v in stamp['inputs'].items()})
+    return up_to_date, current_info
+
+
+def load_script(script):
+    """
+    Import a script as a module (once per process), so its main function can be called with a list of arguments.
+    """
+    module_name = os.path.splitext(os.path.basename(script))[0]
+    if module_name not in sys.modules:
+        # scripts import helpers from their own directory
+        sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+        spec = importlib.util.spec_from_file_location(module_name, script)
+        sys.modules[module_name] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sys.modules[module_name])
+    return sys.modules[module_name]
+
+
+def run_script(script, script_args):
+    """
+    Run a script in this process as if from the command line, so imports are reused between runs.
+    """
+    load_script(script).main(script_args)
+
+
+def run_stages(stages):
+    """
+    Run stages in order, skipping those that are up to date. A stage whose inputs are missing (e.g. because an
+    earlier stage failed) is not run.
+
+    Returns a list of (stage name, status).
+    """
+    status = []
+    for stage in stages:
+        missing = [x for x in stage['inputs'] if not os.path.exists(x)]
+        if missing:
+            status.append((stage['name'], 'failed: missing ' + ', '.join(missing)))
+            continue
+        up_to_date, current_info = stage_up_to_date(stage)
+        if up_to_date:
+            status.append((stage['name'], 'up to date'))
+            continue
+        try:
+            run_script(stage['script'], stage['args'])
+        except (Exception, SystemExit) as e:
+            status.append((stage['name'], 'failed: ' + repr(e)))
+            continue
+        with open(stage_stamp(stage), 'w') as f:
+            json.dump({'args': stage['args'], 'inputs': current_info}, f, indent=1)
+        status.append((stage['name'], 'done'))
+    return status
+
+
+def subject_memory(dwi):
+    # rough peak memory (GB) of fitting a DWI: float64 data, a working copy and model parameters
+    import nibabel as nib
+    return np.prod(nib.load(dwi).shape) * 8 * 3 / 1024 ** 3
+
+
+# collect inputs
+parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                        description=__description__)
+
+parser.add_argument('-bd', '--bids_dir',
+                    help='BIDS directory with sub-*/[ses-*/]dwi/*_dwi.nii.gz, .bval and .bvec files.',
+                    required=True)
+parser.add_argument('-st', '--stages',
+                    help='Stages to run (space separated). Default is fwdti dki.',
+                    nargs='+',
+                    choices=list(stage_scripts),
+                    default=['fwdti', 'dki'])
+parser.add_argument('-fs', '--fwdti_shells',
+                    help='Shells to extract for fwDTI, comma separated (e.g. 0,1000). Default is all volumes.',
+                    required=False)
+parser.add_argument('-ds', '--dki_shells',
+                    help='Shells to extract for DKI, comma separated (e.g. 0,1000,2000). Default is all volumes.',
+                    required=False)
+parser.add_argument('-t', '--threshold',
+                    help='b-value threshold for extracting shells. Default=0.',
+                    default=0,
+                    type=int)
+parser.add_argument('-s', '--smooth',
+                    help='Smooth the data before fitting DKI. Default is False.',
+                    action='store_true')
+parser.add_argument('-fa', '--fit_args',
+                    help='Extra arguments passed to both fitting scripts, in quotes (e.g. "--crop --n_jobs 1"). '
+                         'Output names follow its --metrics, --compress_level, --single_file and --preview '
+                         '(the last two can\'t be used with the roi stage).',
+                    default='')
+parser.add_argument('-l', '--labels',
+                    help='Label image for the roi stage, relative to --bids_dir. {sub}, {ses} and {entities} '
+                         '(e.g. sub-01_ses-1) are replaced for each DWI, '
+                         'e.g. derivatives/gif/{sub}/{sub}_labels.nii.gz',
+                    required=False)
+parser.add_argument('-o', '--output',
+                    help='Output file of the collate stage, saved in --bids_dir/derivatives/neuroimaging_helper. '
+                         'Default is all_roi_metrics.csv',
+                    default='all_roi_metrics.csv')
+parser.add_argument('-mb', '--memory_budget',
+                    help='Memory (GB) that subjects running at the same time can use. Default is 16.',
+                    default=16,
+                    type=float)
+parser.add_argument('-sm', '--subject_memory',
+                    help='Memory (GB) each subject needs. Default is estimated from the size of each DWI.',
+                    type=float)
+parser.add_argument('-n', '--n_jobs',
+                    help='Maximum number of subjects to run at the same time. Default is the number of CPUs.',
+                    type=int)
+parser.add_argument('-dc', '--dwi_cache',
+                    help='Directory to cache decompressed DWIs in, passed to the shells, fwdti and dki stages (see '
+                         'process_dki.py --dwi_cache). Each DWI is then decompressed once rather than by each '
+                         'stage. Default is no cache.')
+parser.add_argument('-dcs', '--dwi_cache_size',
+                    help='Maximum size of --dwi_cache in GB. Default is 20.',
+                    default=20,
+                    type=float)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    dwis = find_dwis(args.bids_dir)
+    print('Found ' + str(len(dwis)) + ' DWIs')
+    if ('shells' in args.stages) != bool(args.fwdti_shells or args.dki_shells):
+        parser.error('The shells stage needs --fwdti_shells and/or --dki_shells (and vice versa)')
+    if 'roi' in args.stages and not args.labels:
+        parser.error('The roi stage needs --labels')
+
+    # run subjects while their estimated memory fits within the budget
+    pending = [(dwi, subject_memory(dwi) if args.subject_memory is None else args.subject_memory,
+                subject_stages(dwi, bval, bvec, args)) for dwi, bval, bvec in dwis]
+    running = {}
+    failed = []
+    n_jobs = args.n_jobs or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        while pending or running:
+            used_memory = sum(x[1] for x in running.values())
+            # always run at least one subject, even if it needs more than the budget
+            while pending and len(running) < n_jobs and \
+                    (not running or used_memory + pending[0][1] <= args.memory_budget):
+                dwi, memory, stages = pending.pop(0)
+                running[pool.submit(run_stages, stages)] = (dwi, memory)
+                used_memory += memory
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                dwi, _ = running.pop(future)
+                for stage_name, status in future.result():
+                    print(dwi + ' ' + stage_name + ': ' + status)
+                    if status.startswith('failed') and dwi not in failed:
+                        failed.append(dwi)
+
+    # collate every subject's roi metrics
+    if 'collate' in args.stages:
+        try:
+            run_script(stage_scripts['collate'], ['-pd', derivatives_dir(args.bids_dir), '-ew', '_roi_metrics.csv',
+                                                  '-o', args.output, '--incremental'])
+        except (Exception, SystemExit) as e:
+            print('collate: failed: ' + repr(e))
+            failed.append(args.output)
+
+    if failed:
+        print(str(len(failed)) + ' DWIs (or collate) failed:\n' + '\n'.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import os
+import csv
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import numpy as np
+from dwi_utils import brain_mask, load_dwi
+from process_dki import dki_metrics, dki_model, fit_dki
+from process_freewater_dti import fwdti_metrics, fwdti_model, fit_fwdti
+
+__description__ = '''
+Check how much fitting in float32 (--precision float32 in process_dki.py and process_freewater_dti.py) changes the
+metrics of a subject compared to fitting in float64.
+
+Each model is fitted twice, in float64 and in float32, within the same mask (so only the precision of the fit
+differs), and for every metric the maximum and median absolute difference within the mask are reported, along with
+the median absolute float64 value for scale and the fitting time of each precision. Nothing is saved apart from the
+optional --output csv of these differences.
+
+DKI is compared without smoothing, as process_dki.py --smooth always smooths and fits in float32 whatever the
+precision.
+
+For example:
+
+    python /path/to/validate_precision.py -i dwi.nii.gz -bval dwi.bval -bvec dwi.bvec -m mask.nii.gz -o precision.csv
+'''
+
+# collect inputs
+parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                        description=__description__)
+
+parser.add_argument('-i', '--dwi',
+                    help='Preprocessed diffusion weighted images (i.e. after TOPUP and eddy)',
+                    required=True)
+parser.add_argument('-bval', '--bval',
+                    help='File with bvalues in (.bval)',
+                    required=True)
+parser.add_argument('-bvec', '--bvec',
+                    help='File with bvecs in (.bvec)',
+                    required=True)
+parser.add_argument('-m', '--mask',
+                    help='File with mask to fit models within. If not specified, simple dipy brain extraction '
+                         'masking will be done (in float64).',
+                    required=False)
+parser.add_argument('-mo', '--models',
+                    help='Models to compare (space separated). Default is fwdti dki.',
+                    nargs='+',
+                    choices=['fwdti', 'dki'],
+                    default=['fwdti', 'dki'],
+                    required=False)
+parser.add_argument('-n', '--n_jobs',
+                    help='Number of processes to fit the models with. Default is 1.',
+                    type=int,
+                    default=1,
+                    required=False)
+parser.add_argument('-o', '--output',
+                    help='Output csv of metric differences. Default is to only print them.',
+                    required=False)
+parser.add_argument('-dc', '--dwi_cache',
+                    help='Directory to cache decompressed DWIs in, as for process_dki.py --dwi_cache. The DWI is then '
+                         'decompressed once for all fits instead of once per fit. Default is no cache.',
+                    required=False)
+parser.add_argument('-dcs', '--dwi_cache_size',
+                    help='Maximum size of --dwi_cache in GB. Least recently used DWIs are removed. Default is 20.',
+                    type=float,
+                    default=20,
+                    required=False)
+
+
+def compare_precision(fit_function, metrics, mask, **fit_args):
+    """
+    Fit a model in float64 and float32 and compare every metric within mask.
+
+    Returns a list of dictionaries of the differences for each metric.
+    """
+    fitted = {}
+    fit_time = {}
+    for precision in ['float64', 'float32']:
+        t0 = time.time()
+        fitted[precision] = fit_function(metrics=list(metrics), mask=mask, precision=precision, **fit_args)
+        fit_time[precision] = time.time() - t0
+
+    differences = []
+    for metric in metrics:
+        map64 = fitted['float64'][metric][mask]
+        map32 = fitted['float32'][metric][mask]
+        # compare voxels where both fits are finite
+        finite = np.isfinite(map64) & np.isfinite(map32)
+        abs_diff = np.abs(map64[finite] - map32[finite])
+        differences.append({'Metric': metric,
+                            'Voxels': int(finite.sum()),
+                            'NonFinite': int((~finite).sum()),
+                            'MaxAbsDiff': abs_diff.max() if abs_diff.size else np.nan,
+                            'MedianAbsDiff': np.median(abs_diff) if abs_diff.size else np.nan,
+                            'MedianAbsValue': np.median(np.abs(map64[finite])) if abs_diff.size else np.nan,
+                            'Float64Time': fit_time['float64'],
+                            'Float32Time': fit_time['float32']})
+    return differences
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    # one mask for both precisions so only the fit differs
+    img = load_dwi(args.dwi, args.dwi_cache, args.dwi_cache_size)
+    mask = brain_mask(img, args.dwi, args.mask)
+
+    model_fits = {'fwdti': ('fwDTI', fit_fwdti, fwdti_metrics, fwdti_model),
+                  'dki': ('DKI', fit_dki, dki_metrics, dki_model)}
+    differences = []
+    fit_times = []
+    for model in args.models:
+        model_name, fit_function, metrics, init_model = model_fits[model]
+        print("Comparing " + model_name + " fits...")
+        model_differences = compare_precision(fit_function, metrics, mask,
+                                              dwi=args.dwi, bval=args.bval, bvec=args.bvec,
+                                              n_jobs=args.n_jobs,
+                                              dwi_cache=args.dwi_cache,
+                                              dwi_cache_size=args.dwi_cache_size,
+                                              model=init_model(args.bval, args.bvec))
+        for row in model_differences:
+            row['Metric'] = model_name + '_' + row['Metric']
+        differences.extend(model_differences)
+        fit_times.append(model_name + ' fitting took ' + '{:.2f}'.format(model_differences[0]['Float64Time'] / 60) +
+                         ' minutes in float64 and ' + '{:.2f}'.format(model_differences[0]['Float32Time'] / 60) +
+                         ' minutes in float32')
+
+    # print and save differences
+    print('')
+    print('{:<12}{:>10}{:>14}{:>16}{:>16}'.format('Metric', 'Voxels', 'MaxAbsDiff', 'MedianAbsDiff', 'MedianAbsValue'))
+    for row in differences:
+        print('{Metric:<12}{Voxels:>10}{MaxAbsDiff:>14.3g}{MedianAbsDiff:>16.3g}{MedianAbsValue:>16.3g}'.format(**row))
+    print('\n'.join(fit_times))
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, list(differences[0]))
+            writer.writeheader()
+            writer.writerows(differences)
+        print('Precision differences saved to: ' + os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    main()
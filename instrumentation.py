@@ -0,0 +1,199 @@
+"""
+Per-stage timing and memory instrumentation shared by the scripts in diffusion_mri, regions_of_interest and csv.
+
+A script wraps its run in record_run, and marks the stages of its processing (e.g. loading, masking, fitting,
+saving) with stage. For each stage the wall time, CPU time (including finished worker processes), peak resident
+memory (RSS) and bytes read and written are recorded, and when the run finishes one JSON line describing it is
+appended to a run log next to the outputs (<script>_runs.jsonl by default). Optionally one stage is profiled with
+cProfile, saved as <run log>_<stage>.prof (view with e.g. python -m pstats or snakeviz).
+
+stage does nothing outside record_run, so library functions can mark stages whether or not they are called from an
+instrumented script. Peak RSS is reset at the start of each stage on linux (through /proc/self/clear_refs), so it is
+the peak within the stage. Elsewhere, or if that isn't allowed, it is the peak of the run so far. Bytes read and
+written come from /proc/self/io (all reads and writes of this process, including cached files but not memory-mapped
+ones) and are null if that isn't available.
+
+Scripts import this from the top of the repository, e.g.
+
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from instrumentation import add_run_log_args, record_run, stage
+
+peak_rss_mb and reset_peak_rss can also be used directly to measure the peak memory of a block of code (as the
+benchmarks do).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import resource
+from contextlib import contextmanager
+from datetime import datetime
+
+# runs being recorded, innermost last (a recorded script can call another's main)
+_runs = []
+
+
+def add_run_log_args(parser):
+    """
+    Add the --run_log and --profile options to a script's argument parser.
+    """
+    parser.add_argument('-rl', '--run_log',
+                        help='JSON-lines file to append a record of the time, memory and I/O of each stage of this run '
+                             'to, or "none" to not record it. Default is <script>_runs.jsonl next to the outputs.',
+                        required=False)
+    parser.add_argument('-pf', '--profile',
+                        help='Name of a stage to profile with cProfile (e.g. fit), saved next to the run log as '
+                             '<run log>_<stage>.prof. Default is no profiling.',
+                        required=False)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory (MB) of this process since the last reset_peak_rss (linux) or since it started.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on linux and bytes on mac
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    """
+    Reset peak_rss_mb to the current resident memory, where /proc/self/clear_refs is available.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _io_bytes():
+    # bytes read and written by this process so far, or None if not available
+    try:
+        with open('/proc/self/io') as f:
+            io_counts = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io_counts['rchar']), int(io_counts['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class _Counters:
+    # wall time, cpu time and I/O at a point in time, to measure the difference to a later point
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = sum(os.times()[:4])
+        self.io = _io_bytes()
+
+    def since(self, start):
+        return {'wall_s': round(self.wall - start.wall, 6),
+                'cpu_s': round(self.cpu - start.cpu, 6),
+                'read_mb': round((self.io[0] - start.io[0]) / 1024 ** 2, 3) if self.io and start.io else None,
+                'written_mb': round((self.io[1] - start.io[1]) / 1024 ** 2, 3) if self.io and start.io else None}
+
+
+class RunRecord:
+    """
+    Stage measurements of one run of a script. Use through record_run and stage.
+    """
+
+    def __init__(self, script, run_log, profile_stage=None, **info):
+        self.script = script
+        self.run_log = run_log
+        self.profile_stage = profile_stage
+        self.profiler = cProfile.Profile() if profile_stage else None
+        self.info = info
+        self.stages = []
+        self.peak_rss_mb = 0
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.start = _Counters()
+
+    @contextmanager
+    def stage(self, name):
+        reset_peak_rss()
+        start = _Counters()
+        if name == self.profile_stage:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if name == self.profile_stage:
+                self.profiler.disable()
+            stage_record = {'stage': name}
+            stage_record.update(_Counters().since(start))
+            stage_record['peak_rss_mb'] = round(peak_rss_mb(), 3)
+            self.peak_rss_mb = max(self.peak_rss_mb, stage_record['peak_rss_mb'])
+            self.stages.append(stage_record)
+
+    def save(self, status, error=None):
+        """
+        Append this run's record to the run log (and save the profile if there is one).
+        """
+        record = {'script': self.script,
+                  'started': self.started,
+                  'host': socket.gethostname(),
+                  'pid': os.getpid(),
+                  'status': status,
+                  'error': error}
+        record.update(self.info)
+        record.update(_Counters().since(self.start))
+        record['peak_rss_mb'] = round(max(self.peak_rss_mb, peak_rss_mb()), 3)
+        record['stages'] = self.stages
+        if self.profiler:
+            profile_file = os.path.splitext(self.run_log)[0] + '_' + self.profile_stage + '.prof'
+            self.profiler.dump_stats(profile_file)
+            record['profile'] = profile_file
+
+        if os.path.dirname(self.run_log):
+            os.makedirs(os.path.dirname(self.run_log), exist_ok=True)
+        with open(self.run_log, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        return record
+
+
+@contextmanager
+def record_run(script, args, out_dir):
+    """
+    Record the stages of a script's run and append the record to a run log when it finishes (or fails).
+
+    script: name of the script (e.g. 'process_dki')
+    args: parsed arguments, including --run_log and --profile from add_run_log_args. All arguments are saved in
+        the record.
+    out_dir: directory of the outputs, where the run log is saved by default
+    """
+    if args.run_log and args.run_log.lower() == 'none':
+        yield None
+        return
+
+    run_log = args.run_log or os.path.join(out_dir or '.', script + '_runs.jsonl')
+    run = RunRecord(script, run_log, args.profile, args=vars(args))
+    _runs.append(run)
+    try:
+        yield run
+    except BaseException as e:
+        _runs.remove(run)
+        run.save('failed', repr(e))
+        raise
+    _runs.remove(run)
+    run.save('finished')
+    print('Run record saved to: ' + run_log)
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure a stage of the run being recorded (if any).
+    """
+    if not _runs:
+        yield
+        return
+    with _runs[-1].stage(name):
+        yield
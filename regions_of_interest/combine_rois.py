@@ -1,11 +1,26 @@
+import os
+import sys
+import json
 import numpy as np
-import nibabel as nib
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
 
 __description__ = '''
 This script combines labels into one binary mask. All labels must exist in the input image with unique label values.
 Useful if wanting to combine multiple labels into one signature region.
 
+Many signature regions can be made from one read of the input image with --spec, a json file of region names and
+the labels combined into each, e.g.
+
+    {"temporal": [1001, 1002, 1003], "frontal": [2001, 2002]}
+
+These are saved as separate masks (--out_dir/<name>.nii.gz) or as volumes of one 4D mask (--out_4d) in the order
+of the spec file.
+
+Masks can also be made from python with combine_rois (importing this script with its directory on the python path),
+e.g. masks, affine = combine_rois('gif_labels.nii.gz', {"temporal": [1001, 1002, 1003]})
+
 Author: Tom Veale
 Email: tom.veale@ucl.ac.uk
 '''
@@ -20,24 +35,120 @@ parser.add_argument('-i', '--input_file',
 parser.add_argument('-r', '--regions',
                     help='List of values in --input_file that correspond to regions to be combined (space separated).'
                     'E.g. 1001 1002 1003',
-                    required=True,
+                    required=False,
                     type=int,
                     nargs='+')
 parser.add_argument('-o', '--out_mask',
                     help='Output nifti mask that is the combination of --regions.'
                     'E.g. voxels that equal 1001 or 1002 or 1003 = 1 (otherwise = 0)',
-                    required=True)
-args = parser.parse_args()
+                    required=False)
+parser.add_argument('-s', '--spec',
+                    help='json file of region names and lists of labels to combine for each (instead of --regions).',
+                    required=False)
+parser.add_argument('-od', '--out_dir',
+                    help='Output directory for a mask per region in --spec.',
+                    required=False)
+parser.add_argument('-o4', '--out_4d',
+                    help='Output 4D nifti with a mask volume per region in --spec, instead of --out_dir.',
+                    required=False)
+add_run_log_args(parser)
+
+
+def check_region_groups(region_groups):
+    """
+    Raise a ValueError naming the first region that isn't a non-empty list of non-negative integer labels.
+    """
+    for name, regions in region_groups.items():
+        if not isinstance(regions, (list, tuple)) or not regions or \
+                not all(isinstance(x, (int, np.integer)) and not isinstance(x, bool) and x >= 0 for x in regions):
+            raise ValueError('Labels of region ' + str(name) + ' must be a non-empty list of non-negative integers, '
+                             'not ' + json.dumps(regions, default=str))
+
+
+def combine_rois(input_file, region_groups):
+    """
+    Combine labels of a label image into binary masks.
+
+    region_groups: dictionary of region name -> list of labels to combine
+
+    Returns a 4D uint8 array with a mask volume for each region (in the order of region_groups) and the affine
+    of the label image.
+    """
+    import nibabel as nib
+
+    check_region_groups(region_groups)
+
+    # load image labels as integers
+    input_img = nib.load(input_file)
+    with stage('load'):
+        labels = np.asanyarray(input_img.dataobj)
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.rint(labels).astype(np.int64)
+    if labels.min() < 0:
+        raise ValueError('Negative labels found in ' + input_file)
+
+    # lookup table of label value -> mask value for each group (a label can be in more than one group)
+    # indexing it with the label image creates every mask in one pass
+    # (the size is a python int, as labels.max() + 1 would overflow at the maximum of the label dtype)
+    lut = np.zeros((max(int(labels.max()), max(max(x) for x in region_groups.values())) + 1, len(region_groups)),
+                   dtype='uint8')
+    for igroup, regions in enumerate(region_groups.values()):
+        lut[regions, igroup] = 1
+    with stage('combine'):
+        combined_masks = lut[labels]
+    return combined_masks, input_img.affine
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    # get the groups of labels to combine
+    if args.spec:
+        if not (args.out_dir or args.out_4d):
+            parser.error('--out_dir or --out_4d is required with --spec')
+        with open(args.spec) as f:
+            region_groups = json.load(f)
+    elif args.regions and args.out_mask:
+        region_groups = {args.out_mask: args.regions}
+    else:
+        parser.error('--regions and --out_mask, or --spec, are required')
+    try:
+        check_region_groups(region_groups)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import nibabel as nib
+
+    if args.spec:
+        out_dir = os.path.dirname(args.out_4d) if args.out_4d else args.out_dir
+    else:
+        out_dir = os.path.dirname(args.out_mask)
+
+    with record_run('combine_rois', args, out_dir):
+        combined_masks, affine = combine_rois(args.input_file, region_groups)
+
+        with stage('save'):
+            if args.spec and args.out_4d:
+                # create one 4D image of all combined regions
+                combined_mask_img = nib.Nifti1Image(combined_masks, affine, dtype='uint8')
+                combined_mask_img.header['descrip'] = ','.join(region_groups)[:79]
+                nib.save(combined_mask_img, args.out_4d)
+                print('Combined masks saved (' + ', '.join(region_groups) + '): ', args.out_4d)
+            else:
+                if args.spec and not os.path.exists(args.out_dir):
+                    print("Creating new directory: ", args.out_dir)
+                    os.makedirs(args.out_dir)
+
+                for igroup, name in enumerate(region_groups):
+                    out_mask = os.path.join(args.out_dir, name + '.nii.gz') if args.spec else name
 
-# load image
-input_img = nib.load(args.input_file)
+                    # create image for combined region
+                    combined_mask_img = nib.Nifti1Image(combined_masks[..., igroup], affine, dtype='uint8')
 
-# create mask of voxels that equal values provided - output as int type
-combined_mask = np.isin(input_img.get_fdata(), args.regions).astype(int)
+                    # save new image
+                    nib.save(combined_mask_img, out_mask)
+                    print('Combined mask saved: ', out_mask)
 
-# create image for combined region
-combined_mask_img = nib.Nifti1Image(combined_mask, input_img.affine, dtype='uint8')
 
-# save new image
-nib.save(combined_mask_img, args.out_mask)
-print('Combined mask saved: ', args.out_mask)
+if __name__ == '__main__':
+    main()
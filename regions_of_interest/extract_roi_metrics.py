@@ -0,0 +1,154 @@
+import os
+import sys
+import numpy as np
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
+
+__description__ = '''
+This script extracts summary statistics of parametric maps (e.g. fwFA, fwMD, FW or MK, AK, RK) within each label
+of a label image (e.g. a GIF parcellation or combine_rois.py output).
+
+For every non-zero label and map, the voxel count, volume (mm^3), mean, standard deviation and median are saved as
+one row of a long format csv (columns: Label, Map, Voxels, Volume, Mean, Std, Median). Make the output filename
+subject specific (e.g. sub-01_roi_metrics.csv) and collate subjects with csv/concatenate_csvs.py.
+
+All labels are summarised together in one pass per map, rather than masking the map once per label. Voxels where a
+map is not finite (nan/inf) are left out of that map's statistics. Maps must be 3D and in the same space as the
+labels.
+
+The label image can also be a 4D mask with a (possibly overlapping) region per volume, e.g. combine_rois.py
+--out_4d. Each volume is then summarised as one label, named by the region names combine_rois.py saves in the
+header description (or numbered from 1 in volume order if there isn't one name per volume).
+
+For example:
+
+    python /path/to/extract_roi_metrics.py -i gif_labels.nii.gz -m dwi_fwDTI_FA.nii.gz dwi_fwDTI_MD.nii.gz
+        -o sub-01_roi_metrics.csv
+
+Or from python with extract_roi_metrics (importing this script with its directory on the python path), which returns
+the same table as a pandas dataframe, e.g. extract_roi_metrics('gif_labels.nii.gz', ['dwi_fwDTI_FA.nii.gz'])
+'''
+
+# collect inputs
+parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                        description=__description__)
+
+parser.add_argument('-i', '--input_file',
+                    help='Input nifti file with separately labelled regions.',
+                    required=True)
+parser.add_argument('-m', '--maps',
+                    help='Parametric maps to summarise within each label (space separated).',
+                    required=True,
+                    nargs='+')
+parser.add_argument('-n', '--map_names',
+                    help='Names for each of --maps in the Map column (space separated). Default is the map filenames.',
+                    required=False,
+                    nargs='+')
+parser.add_argument('-o', '--output',
+                    help='Output csv file of ROI metrics (e.g. sub-01_roi_metrics.csv).',
+                    required=True)
+add_run_log_args(parser)
+
+
+def extract_roi_metrics(input_file, maps, map_names=None):
+    """
+    Summary statistics of each map within each non-zero label of a label image.
+
+    maps: list of map filenames, named map_names in the Map column (default is the map filenames)
+
+    Returns a long format dataframe with columns Label, Map, Voxels, Volume, Mean, Std, Median.
+    """
+    import nibabel as nib
+    import pandas as pd
+
+    map_names = map_names or [os.path.basename(x).split('.nii')[0] for x in maps]
+
+    # load image labels as integers, keeping only labelled voxels
+    input_img = nib.load(input_file)
+    if input_img.ndim not in (3, 4):
+        raise ValueError(input_file + ' is not a 3D label image or 4D mask!')
+    with stage('load_labels'):
+        labels = np.asanyarray(input_img.dataobj)
+        if not np.issubdtype(labels.dtype, np.integer):
+            labels = np.rint(labels).astype(np.int64)
+        if labels.min() < 0:
+            raise ValueError('Negative labels found in ' + input_file)
+        if labels.ndim == 4:
+            # a mask per volume (regions can overlap), so each labelled voxel of each volume is summarised with
+            # the volume number (from 1) as its label
+            x, y, z, volume = np.nonzero(labels)
+            labelled = (x, y, z)
+            roi_labels = volume + 1
+        else:
+            labelled = labels > 0
+            roi_labels = labels[labelled]
+    voxel_volume = np.prod(input_img.header.get_zooms()[:3])
+
+    # names of the volumes of a combine_rois.py --out_4d mask
+    label_names = None
+    if labels.ndim == 4:
+        label_names = input_img.header['descrip'].item().decode(errors='replace').split(',')
+        if len(label_names) != labels.shape[3]:
+            label_names = None
+
+    roi_metrics = []
+    for map_file, map_name in zip(maps, map_names):
+        map_img = nib.load(map_file)
+        if map_img.ndim != 3:
+            raise ValueError(map_file + ' is not a 3D map!')
+        if map_img.shape != labels.shape[:3]:
+            raise ValueError(map_file + ' is not the same shape as ' + input_file)
+        print('Extracting ROI metrics from: ' + map_file)
+        with stage('load_map'):
+            map_values = map_img.get_fdata()[labelled]
+
+        with stage('summarise'):
+            # drop voxels where the map isn't finite
+            finite = np.isfinite(map_values)
+            map_labels = roi_labels[finite]
+            map_values = map_values[finite]
+
+            # voxel count, mean and std of every label in one pass each
+            counts = np.bincount(map_labels)
+            found = np.flatnonzero(counts)
+            means = np.bincount(map_labels, weights=map_values)[found] / counts[found]
+            mean_lookup = np.zeros(counts.shape)
+            mean_lookup[found] = means
+            stds = np.sqrt(np.bincount(map_labels, weights=(map_values - mean_lookup[map_labels]) ** 2)[found] /
+                           counts[found])
+
+            # median of every label from one sort by label then value
+            sorted_values = map_values[np.lexsort((map_values, map_labels))]
+            starts = np.cumsum(counts[found]) - counts[found]
+            medians = (sorted_values[starts + (counts[found] - 1) // 2] +
+                       sorted_values[starts + counts[found] // 2]) / 2
+
+            roi_metrics.append(pd.DataFrame({'Label': found if label_names is None else
+                                             [label_names[x - 1] for x in found],
+                                             'Map': map_name,
+                                             'Voxels': counts[found],
+                                             'Volume': counts[found] * voxel_volume,
+                                             'Mean': means,
+                                             'Std': stds,
+                                             'Median': medians}))
+
+    return pd.concat(roi_metrics, ignore_index=True)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.map_names and len(args.map_names) != len(args.maps):
+        parser.error('--map_names must have one name for each of --maps')
+
+    with record_run('extract_roi_metrics', args, os.path.dirname(args.output)):
+        roi_metrics = extract_roi_metrics(args.input_file, args.maps, args.map_names)
+
+        # save ROI metrics in long format
+        with stage('save'):
+            roi_metrics.to_csv(args.output, index=False)
+        print('ROI metrics saved: ', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,128 @@
 import os
+import sys
 import argparse as ap
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import xml.etree.ElementTree as et
 import csv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import add_run_log_args, record_run, stage
 
 """
 Extracts GIF volumes from xml files and puts them into a spreadsheet.
 
+Only the labels and tissues items are pulled from each xml file and files are parsed in parallel. Subjects do not
+need the same set of labels - the spreadsheet has a column for every label found in any subject, left empty for
+subjects without it. The output is saved as csv, or parquet if outfile ends in .parquet (needs pandas and pyarrow).
+
+Volumes can also be read from python with read_gif_volumes (importing this script with its directory on the python
+path), which returns a list of dictionaries, one per xml file.
+
 Author: Tom Veale - adapted from Dave Cash's code
 
 """
 
+# collect inputs
 parser = ap.ArgumentParser(description='Read GIF Parcellations')
 parser.add_argument('indir', type=str,
                     help='GIF output directory where xml files stored')
 parser.add_argument('outfile', type=str,
-                    help='Output CSV file for collected data')
+                    help='Output CSV (or .parquet) file for collected data')
 parser.add_argument('--giftype', type=str,
                     help='prob for volumeProb or cat for volumeCat')
-args=parser.parse_args()
-
-
-# Set which gif measure to use depending on user input
-if not args.giftype:
-    gif_measure = 'volumeProb'
-    print('No GIF measurement type selected - Using volumeProb as default')
-elif args.giftype == 'prob':
-    gif_measure = 'volumeProb'
-elif args.giftype == 'cat':
-    gif_measure = 'volumeCat'
-
-# walk through all directories in indir and get list of xml files
-xml_files = []
-for root, dirs, files in os.walk(args.indir):
-    for ifile in files:
-        if ifile.endswith('.xml'):
-            print(os.path.join(root, ifile))
-            xml_files.append(os.path.join(root, ifile))
-
-#xml_files = glob.glob(args.indir + '*.xml')
-gif_list = []
-
-# loop through each file and get subject's labels and associated volumes
-for filename in xml_files:
-    subj_xml = filename.split('/')[-1]
-    print subj_xml
-
-    # Parse GIF labels and tissue vols from xml
-    parc_tree = et.parse(filename)
-    parc_root = parc_tree.getroot()
-    parc_labels = parc_root.find('labels')
-    rois = parc_labels.findall('item')
-    # add meta-tissues for TIV here
-    parc_tiss = parc_root.find('tissues')
-    tiss = parc_tiss.findall('item')
-    [rois.append(x) for x in tiss[1:]]      # miss Non-Brain Outer Tissue for now (label conflict)
-
-    # create subject dictionary
+parser.add_argument('--n_jobs', type=int,
+                    help='Number of processes to parse xml files with. Default is the number of CPUs.')
+add_run_log_args(parser)
+
+
+def read_gif_xml(filename, gif_measure):
+    """
+    Read GIF label and tissue volumes from one xml file into a dictionary of 'number - name' -> volume.
+    """
     roi_dict = OrderedDict()
-    roi_dict['XML'] = subj_xml
+    roi_dict['XML'] = os.path.basename(filename)
     roi_dict['Filename'] = filename
 
-    # for each GIF ROI for this subject
-    for r in rois:
-        roi_id = r.find('number')
-        roi_name = r.find('name')
-        roi_vol = r.find(gif_measure)
-        roi_label = str(roi_id.text) + ' - ' + roi_name.text
-        roi_dict[roi_label] = roi_vol.text
-    gif_list.append(roi_dict)
-
-# Create pandas dataframe and write to csv
-# total_gif = pd.DataFrame(gif_list)
-# total_gif.to_csv(args.outfile, index=False)
-
-# write list of GIF ROIs dictionaries to csv
-with open(args.outfile, 'wb') as output_file:
-    dict_writer = csv.DictWriter(output_file, gif_list[0].keys())
-    dict_writer.writeheader()
-    dict_writer.writerows(gif_list)
-
-print('GIF volumes saved to ' + args.outfile)
+    # only items directly in <labels> or <tissues> under the root are read, everything else is discarded as parsed
+    path = []
+    n_tissues = 0
+    for event, elem in et.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+        path.pop()
+        if elem.tag == 'item' and len(path) == 2 and path[1] in ['labels', 'tissues']:
+            if path[1] == 'tissues':
+                n_tissues += 1
+                # miss Non-Brain Outer Tissue for now (label conflict)
+                if n_tissues == 1:
+                    elem.clear()
+                    continue
+            roi_label = str(elem.findtext('number')) + ' - ' + elem.findtext('name')
+            roi_dict[roi_label] = float(elem.findtext(gif_measure))
+        if len(path) <= 2:
+            elem.clear()
+    return roi_dict
+
+
+def read_gif_volumes(indir, gif_measure='volumeProb', n_jobs=None):
+    """
+    Read GIF volumes from every xml file under indir, in parallel over n_jobs processes (default is the number of
+    CPUs).
+
+    Returns a list of dictionaries of 'number - name' -> volume for each xml file, and a list of every column found
+    in any of them, in the order they first appear.
+    """
+    # walk through all directories in indir and get list of xml files
+    xml_files = []
+    for root, dirs, files in os.walk(indir):
+        for ifile in files:
+            if ifile.endswith('.xml'):
+                print(os.path.join(root, ifile))
+                xml_files.append(os.path.join(root, ifile))
+
+    # parse each file in parallel to get subject's labels and associated volumes
+    n_jobs = n_jobs or os.cpu_count()
+    with stage('parse'), ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        gif_list = list(pool.map(partial(read_gif_xml, gif_measure=gif_measure), xml_files,
+                                 chunksize=max(1, len(xml_files) // (8 * n_jobs))))
+
+    # columns for every label found in any subject, in the order they first appear
+    gif_columns = OrderedDict()
+    for roi_dict in gif_list:
+        gif_columns.update(OrderedDict.fromkeys(roi_dict))
+    return gif_list, list(gif_columns)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    # Set which gif measure to use depending on user input
+    if not args.giftype:
+        gif_measure = 'volumeProb'
+        print('No GIF measurement type selected - Using volumeProb as default')
+    elif args.giftype == 'prob':
+        gif_measure = 'volumeProb'
+    elif args.giftype == 'cat':
+        gif_measure = 'volumeCat'
+
+    with record_run('read_gif_csv', args, os.path.dirname(args.outfile)):
+        gif_list, gif_columns = read_gif_volumes(args.indir, gif_measure, args.n_jobs)
+
+        with stage('save'):
+            if args.outfile.endswith('.parquet'):
+                import pandas as pd
+                pd.DataFrame.from_records(gif_list, columns=gif_columns).to_parquet(args.outfile, index=False)
+            else:
+                # write list of GIF ROIs dictionaries to csv
+                with open(args.outfile, 'w', newline='') as output_file:
+                    dict_writer = csv.DictWriter(output_file, gif_columns)
+                    dict_writer.writeheader()
+                    dict_writer.writerows(gif_list)
+
+        print('GIF volumes saved to ' + args.outfile)
+
+
+if __name__ == '__main__':
+    main()